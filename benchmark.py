@@ -0,0 +1,1069 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import random
+import socket
+import hashlib
+import zlib
+import json
+import sqlite3
+import logging
+import argparse
+import tempfile
+import threading
+import statistics
+import resource
+import urllib.parse
+import multiprocessing
+from collections import Counter
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tumblr_backup import TumblrBackup, byte_rate, resolution
+
+POST_TYPES = ['text', 'photo', 'photo', 'photo', 'quote', 'link', 'video', 'audio', 'chat']
+WORDS = ('tumblr backup archive photo summer night city music art film vintage aesthetic '
+         'coffee book quote love life travel nature ocean sky light dark cat dog').split()
+# A long tail of rarer words so text search has realistic selectivity.
+SYLLABLES = 'ka lo mi ne ru sa ti vo ze ba de fi go hu ja'.split()
+RARE_WORDS = [a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES]
+# Synthetic posts are an hour apart, the oldest at this timestamp.
+POST_EPOCH = 1262304000
+
+def make_post(blog_name, index, total, seed=0, media_host=None, media_size=0):
+    """Build a deterministic, Tumblr-shaped post; index 0 is the newest
+
+    Everything about a post, its id included, follows from its age
+    (total - index), so a post stays the same as newer ones are added.
+    With media_host, media URLs point at that server (a MediaHandler) and
+    ask it for media_size bytes, scaled down by pixel count for the smaller
+    photo sizes.
+    """
+    age = total - index
+    rng = random.Random(f'{blog_name}:{age}:{seed}')
+
+    def media_url(host, name, width=1280):
+        if media_host:
+            return f'{media_host}/{name}?size={media_size * width * width // (1280 * 1280)}'
+        return f'https://{host}/{name}'
+
+    post_type = POST_TYPES[age % len(POST_TYPES)]
+    timestamp = POST_EPOCH + age * 3600
+    text = ' '.join(rng.choice(WORDS) if rng.random() < 0.7 else rng.choice(RARE_WORDS)
+                    for _ in range(rng.randint(10, 80)))
+    post = {
+        'id': 100000000000 + (zlib.crc32(blog_name.encode()) % 1000) * 10000000 + age,
+        'blog_name': blog_name,
+        'type': post_type,
+        'state': 'published',
+        'format': 'html',
+        'timestamp': timestamp,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S GMT', time.gmtime(timestamp)),
+        'tags': rng.sample(WORDS, rng.randint(0, 6)),
+        'short_url': f'https://tmblr.co/Z{age:010d}',
+        'summary': text[:60],
+        'reblog_key': f'{rng.getrandbits(32):08x}',
+        'post_url': f'https://{blog_name}.tumblr.com/post/{age}',
+        'slug': '-'.join(text.split()[:4]),
+        'note_count': rng.randint(0, 5000),
+        'blog': {'name': blog_name, 'title': blog_name.title(), 'url': f'https://{blog_name}.tumblr.com/'},
+        'trail': [],
+    }
+    if post_type == 'text':
+        post['title'] = text[:40]
+        post['body'] = f'<p>{text}</p>'
+    elif post_type == 'photo':
+        post['caption'] = f'<p>{text}</p>'
+        post['photos'] = []
+        for n in range(rng.randint(1, 4)):
+            name = f'tumblr_{blog_name}_{age}_{n}'
+            post['photos'].append({
+                'caption': '',
+                'original_size': {'url': media_url('64.media.tumblr.com', f'{name}_1280.jpg'), 'width': 1280, 'height': 960},
+                'alt_sizes': [
+                    {'url': media_url('64.media.tumblr.com', f'{name}_{w}.jpg', w), 'width': w, 'height': w * 3 // 4}
+                    for w in (1280, 640, 500, 400, 250, 100)
+                ],
+            })
+    elif post_type == 'quote':
+        post['text'] = text
+        post['source'] = rng.choice(WORDS)
+    elif post_type == 'link':
+        post['title'] = text[:40]
+        post['url'] = f'https://example.com/{age}'
+        post['description'] = f'<p>{text}</p>'
+    elif post_type == 'chat':
+        post['title'] = text[:30]
+        post['dialogue'] = [
+            {'name': rng.choice(WORDS), 'label': 'a:', 'phrase': ' '.join(rng.sample(WORDS, 5))}
+            for _ in range(rng.randint(2, 6))
+        ]
+    elif post_type == 'video':
+        post['caption'] = f'<p>{text}</p>'
+        post['video_url'] = media_url('va.media.tumblr.com', f'tumblr_{blog_name}_{age}.mp4')
+    elif post_type == 'audio':
+        post['caption'] = f'<p>{text}</p>'
+        post['audio_url'] = media_url('a.tumblr.com', f'tumblr_{blog_name}_{age}.mp3')
+    return post
+
+def make_posts(count, blog_name='benchblog'):
+    return [make_post(blog_name, i, count) for i in range(count)]
+
+def new_backup(workdir):
+    return TumblrBackup(db_path=str(Path(workdir) / 'tumblr_backup.db'), media_dir=str(Path(workdir) / 'media'))
+
+def report(label, count, unit, seconds):
+    rate = count / seconds if seconds else float('inf')
+    print(f"{label:<32} {count:>9} {unit} in {seconds:8.2f}s  {rate:12.1f} {unit}/s")
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the media CDN: /<name>?size=<bytes> returns that many bytes
+
+    Faults are injected at the configured rates: throttle_rate answers 429
+    with Retry-After, error_rate answers 503, and drop_rate cuts the
+    connection halfway through the body.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    connections = 0
+    served = Counter()
+    lock = threading.Lock()
+    throttle_rate = 0.0
+    error_rate = 0.0
+    drop_rate = 0.0
+    retry_after = 1
+    write_rate = 0
+
+    def setup(self):
+        super().setup()
+        with MediaHandler.lock:
+            MediaHandler.connections += 1
+
+    def send_fault(self, status, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        query = self.path.partition('?')[2]
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', query.rpartition('size=')[2] or '0')
+        self.end_headers()
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        size = int(query.rpartition('size=')[2] or 0)
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return self.send_fault(429, [('Retry-After', str(self.retry_after))])
+        if roll < self.throttle_rate + self.error_rate:
+            return self.send_fault(503)
+
+        with MediaHandler.lock:
+            MediaHandler.served[path] += 1
+        body = (hashlib.md5(path.encode()).digest() * (size // 16 + 1))[:size]
+        start = 0
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            start = int(range_header[6:].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+
+        if random.random() < self.drop_rate:
+            self.wfile.write(body[start:start + (size - start) // 2])
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if not self.write_rate:
+            self.wfile.write(body[start:])
+            return
+        for offset in range(start, size, 64 * 1024):
+            self.wfile.write(body[offset:offset + 64 * 1024])
+            time.sleep(min(64 * 1024, size - offset) / self.write_rate)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeTumblrHandler(MediaHandler):
+    """Local stand-in for the Tumblr API in front of MediaHandler's CDN
+
+    Serves /v2/user/info and /v2/blog/<blog>/posts for the synthetic blogs
+    in `blogs` (name -> post count), generating each page on request so
+    blogs of any size cost no memory. Posts link their media back to this
+    server. API requests wait api_latency seconds, media requests
+    cdn_latency; the fault rates apply to both. Pages may be asked for by
+    offset or by `before` timestamp; offset_latency adds that many seconds
+    per 1000 posts skipped, the way deep offsets slow down on Tumblr.
+    /bench/blogs?<blog>=<count> sets a blog's post count, to add new posts
+    at the top between runs.
+    """
+
+    blogs = {}
+    media_size = 0
+    api_latency = 0.0
+    cdn_latency = 0.0
+    offset_latency = 0.0
+
+    def do_GET(self):
+        if not self.path.startswith('/v2/'):
+            time.sleep(self.cdn_latency)
+            return super().do_GET()
+        path, _, query = self.path.partition('?')
+        params = dict(urllib.parse.parse_qsl(query))
+        if path == '/v2/bench/blogs':
+            self.blogs.update((name, int(count)) for name, count in params.items())
+            return self.send_fault(204)
+        time.sleep(self.api_latency)
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return self.send_fault(429, [('Retry-After', str(self.retry_after))])
+        if roll < self.throttle_rate + self.error_rate:
+            return self.send_fault(503)
+
+        blog_name = path.split('/')[3].split('.')[0] if path.startswith('/v2/blog/') else None
+        if path == '/v2/user/info':
+            response = {'user': {'name': 'bench', 'blogs': [{'name': name} for name in self.blogs]}}
+        elif blog_name in self.blogs and path.endswith('/posts'):
+            total = self.blogs[blog_name]
+            offset = int(params.get('offset', 0))
+            if 'before' in params:
+                # Post i is dated POST_EPOCH + (total - i) hours.
+                hours = -(-(int(params['before']) - POST_EPOCH) // 3600)
+                offset = min(max(total - hours + 1, 0), total)
+            else:
+                time.sleep(offset / 1000 * self.offset_latency)
+            limit = min(int(params.get('limit', 20)), 20)
+            media_host = f'http://127.0.0.1:{self.server.server_port}'
+            response = {
+                'blog': {'name': blog_name, 'posts': total},
+                'posts': [make_post(blog_name, i, total, media_host=media_host, media_size=self.media_size)
+                          for i in range(offset, min(offset + limit, total))],
+                'total_posts': total,
+            }
+        else:
+            return self.send_fault(404)
+
+        body = json.dumps({'meta': {'status': 200, 'msg': 'OK'}, 'response': response}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve_fake_tumblr(settings, ports):
+    """Run a FakeTumblrHandler server in this (child) process, so it stays out of the measured RSS"""
+    for name, value in settings.items():
+        setattr(FakeTumblrHandler, name, value)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTumblrHandler)
+    server.daemon_threads = True
+    ports.put(server.server_port)
+    server.serve_forever()
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return 0.0, 0.0
+    return statistics.median(values), values[min(len(values) - 1, int(len(values) * 0.99))]
+
+def start_server(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def save_post_unbatched(backup, post):
+    """save_post as it was before batching: a new connection and commit per post, two queries per tag"""
+    conn = sqlite3.connect(backup.db_path)
+    cursor = conn.cursor()
+    post_id = post['id']
+    cursor.execute('SELECT id FROM posts WHERE id = ?', (post_id,))
+    if cursor.fetchone():
+        conn.close()
+        return False
+    cursor.execute('''
+        INSERT INTO posts (
+            id, blog_name, type, state, format, timestamp, date, tags,
+            short_url, summary, reblog_key, post_url, slug, note_count, raw_data
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (post_id, post.get('blog_name'), post.get('type'), post.get('state'), post.get('format'),
+          post.get('timestamp'), post.get('date'), ','.join(post.get('tags', [])), post.get('short_url'),
+          post.get('summary'), post.get('reblog_key'), post.get('post_url'), post.get('slug'),
+          post.get('note_count'), json.dumps(post)))
+    for tag in post.get('tags', []):
+        cursor.execute('INSERT OR IGNORE INTO tags (tag_name) VALUES (?)', (tag,))
+        cursor.execute('SELECT id FROM tags WHERE tag_name = ?', (tag,))
+        tag_id = cursor.fetchone()[0]
+        cursor.execute('INSERT OR IGNORE INTO post_tags (post_id, tag_id) VALUES (?, ?)', (post_id, tag_id))
+    for media in backup.extract_media_urls(post):
+        cursor.execute('INSERT INTO media (post_id, media_url, media_type, width, height) VALUES (?, ?, ?, ?, ?)',
+                       (post_id, media['url'], media['type'], media.get('width'), media.get('height')))
+    conn.commit()
+    conn.close()
+    return True
+
+def bench_ingest(args):
+    posts = make_posts(args.posts)
+    page_size = 20
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        start = time.perf_counter()
+        for post in posts:
+            save_post_unbatched(backup, post)
+        report('original save_post', len(posts), 'posts', time.perf_counter() - start)
+        backup.close()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        start = time.perf_counter()
+        for post in posts:
+            backup.save_post(post)
+        report('save_post (one post batches)', len(posts), 'posts', time.perf_counter() - start)
+        backup.close()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        start = time.perf_counter()
+        for i in range(0, len(posts), page_size * args.pages_per_batch):
+            backup.save_posts(posts[i:i + page_size * args.pages_per_batch])
+        report(f'save_posts ({args.pages_per_batch} page batches)', len(posts), 'posts', time.perf_counter() - start)
+        backup.close()
+
+def bench_media(args):
+    server = start_server(MediaHandler)
+    base = f'http://127.0.0.1:{server.server_port}'
+    urls = [f'{base}/tumblr_{i}.jpg?size={args.size}' for i in range(args.files)]
+    megabytes = args.files * args.size / 1e6
+
+    def fetch(get, url, workdir):
+        response = get(url, stream=True, timeout=30)
+        response.raise_for_status()
+        with open(Path(workdir) / url.rsplit('/', 1)[1].split('?')[0], 'wb') as f:
+            for chunk in response.iter_content(chunk_size=args.chunk_size):
+                f.write(chunk)
+
+    # The same fetch-and-write code both times; only connection reuse
+    # differs. The session is set up as TumblrBackup.create_session does.
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=args.workers))
+    for label, get in (('new connection per file', requests.get), ('pooled session', session.get)):
+        with tempfile.TemporaryDirectory() as workdir:
+            MediaHandler.connections = 0
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                list(executor.map(lambda url: fetch(get, url, workdir), urls))
+            elapsed = time.perf_counter() - start
+            report(label, args.files, 'files', elapsed)
+            print(f"{'':<32} {megabytes / elapsed:.1f} MB/s, {MediaHandler.connections} connections")
+    session.close()
+
+    server.shutdown()
+
+def run_backlog(db_path, media_dir, workers, results):
+    backup = TumblrBackup(db_path=db_path, media_dir=media_dir, media_workers=workers)
+    start = time.perf_counter()
+    backup.download_all_media()
+    backup.close()
+    results.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+def bench_backlog(args):
+    server = start_server(MediaHandler)
+    base = f'http://127.0.0.1:{server.server_port}'
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        conn = backup.get_connection()
+        conn.executemany(
+            'INSERT INTO media (post_id, media_url, media_type) VALUES (?, ?, ?)',
+            ((i // 4, f'{base}/tumblr_{i}.jpg?size={args.size}', 'image') for i in range(args.rows))
+        )
+        conn.commit()
+        backup.close()
+
+        # Concurrent runs share the backlog through row leases; each reports
+        # its own peak RSS, which should not grow with --rows.
+        results = multiprocessing.Queue()
+        runs = [multiprocessing.Process(target=run_backlog, args=(backup.db_path, str(backup.media_dir),
+                                                                  args.workers, results))
+                for _ in range(args.runs)]
+        start = time.perf_counter()
+        for run in runs:
+            run.start()
+        outcomes = [results.get() for _ in runs]
+        for run in runs:
+            run.join()
+        elapsed = time.perf_counter() - start
+
+        done = sqlite3.connect(backup.db_path).execute("SELECT COUNT(*) FROM media WHERE status = 'done'").fetchone()[0]
+        report(f'download_all_media x{args.runs}', done, 'files', elapsed)
+        for n, (seconds, rss) in enumerate(outcomes):
+            print(f"{f'  run {n + 1}':<32} {seconds:8.2f}s  peak RSS {rss:7.1f} MB")
+        repeats = sum(count - 1 for count in MediaHandler.served.values())
+        print(f"{'':<32} {len(MediaHandler.served)} URLs fetched, {repeats} fetched more than once")
+    server.shutdown()
+
+def bench_hosts(args):
+    image_server = start_server(MediaHandler)
+    video_server = start_server(type('VideoHostHandler', (MediaHandler,), {'write_rate': args.video_rate}))
+    rows = [(f'http://127.0.0.1:{video_server.server_port}/tumblr_{n}.mp4?size={args.video_size}', 'video', None, None)
+            for n in range(args.videos)]
+    rows += [(f'http://127.0.0.1:{image_server.server_port}/tumblr_{n}.jpg?size={args.image_size}', 'image', 500, 375)
+             for n in range(args.images)]
+    configs = [
+        ('fifo', {}),
+        (f'host-workers {args.host_workers}', {'host_workers': args.host_workers}),
+        (f'host-workers {args.host_workers}, small-first', {'host_workers': args.host_workers,
+                                                           'download_order': 'small-first'}),
+        ('small-first, probed', {'download_order': 'small-first', 'probe_sizes': True}),
+    ]
+
+    for label, options in configs:
+        with tempfile.TemporaryDirectory() as workdir:
+            backup = TumblrBackup(db_path=str(Path(workdir) / 'tumblr_backup.db'),
+                                  media_dir=str(Path(workdir) / 'media'), media_workers=args.workers,
+                                  max_bandwidth=args.max_bandwidth, **options)
+            conn = backup.get_connection()
+            conn.executemany('INSERT INTO media (post_id, media_url, media_type, width, height) VALUES (?, ?, ?, ?, ?)',
+                             [(n, *row) for n, row in enumerate(rows)])
+            conn.commit()
+
+            finished = {'image': [], 'video': []}
+            download = backup.download_media
+            start = time.perf_counter()
+
+            def timed_download(media_url, post_id, media_type):
+                result = download(media_url, post_id, media_type)
+                finished[media_type].append(time.perf_counter() - start)
+                return result
+
+            backup.download_media = timed_download
+            backup.download_all_media()
+            elapsed = time.perf_counter() - start
+            size = conn.execute("SELECT TOTAL(original_size) FROM media WHERE status = 'done'").fetchone()[0]
+            backup.close()
+
+        images = percentiles([t * 1000 for t in finished['image']])
+        print(f"{label:<32} all done {elapsed:6.2f}s  {size / 1e6 / elapsed:6.1f} MB/s  "
+              f"images done p50 {images[0] / 1000:6.2f}s p99 {images[1] / 1000:6.2f}s  "
+              f"videos done {max(finished['video'], default=0):6.2f}s")
+
+    image_server.shutdown()
+    video_server.shutdown()
+
+def bench_faults(args):
+    MediaHandler.throttle_rate = args.throttle_rate
+    MediaHandler.error_rate = args.error_rate
+    MediaHandler.drop_rate = args.drop_rate
+    MediaHandler.retry_after = args.retry_after
+    server = start_server(MediaHandler)
+    base = f'http://127.0.0.1:{server.server_port}'
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        backup.retrier.base_delay = args.base_delay
+        posts = make_posts(args.posts)
+        for post in posts:
+            post['type'] = 'video'
+            post['video_url'] = f"{base}/tumblr_{post['id']}.mp4?size={args.size}"
+        backup.save_posts(posts)
+
+        start = time.perf_counter()
+        backup.download_all_media()
+        elapsed = time.perf_counter() - start
+        conn = backup.get_connection()
+        statuses = dict(conn.execute('SELECT status, COUNT(*) FROM media GROUP BY status').fetchall())
+        report('download_all_media with faults', args.posts, 'files', elapsed)
+        print(f"{'':<32} {statuses}")
+        backup.close()
+
+    server.shutdown()
+
+def bench_search(args):
+    import web_viewer
+
+    terms = ['summer', 'vintage coffee', 'kalomi', 'kalomi rusati', 'zeba']
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        posts = make_posts(args.posts)
+        for i in range(0, len(posts), 1000):
+            backup.save_posts(posts[i:i + 1000])
+        conn = backup.get_connection()
+
+        # The baseline is the viewer's fallback without the index; raw_data
+        # is compressed, so only summary can be matched with LIKE.
+        for term in terms:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                conn.execute("""
+                    SELECT id, blog_name, type, summary, date FROM posts
+                    WHERE summary LIKE ?
+                    ORDER BY timestamp DESC LIMIT 10
+                """, (f'%{term}%',)).fetchall()
+            like_ms = (time.perf_counter() - start) / args.repeat * 1000
+
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                conn.execute("""
+                    SELECT posts.id, posts.blog_name, posts.type, posts.summary, posts.date,
+                           snippet(posts_fts, -1, '[', ']', '…', 16)
+                    FROM posts_fts JOIN posts ON posts.id = posts_fts.rowid
+                    WHERE posts_fts MATCH ?
+                    ORDER BY bm25(posts_fts, 10.0, 1.0, 5.0, 2.0) LIMIT 10
+                """, (web_viewer.fts_query(term),)).fetchall()
+            fts_ms = (time.perf_counter() - start) / args.repeat * 1000
+            print(f"{term!r:<20} summary LIKE {like_ms:9.2f} ms   FTS5 {fts_ms:9.2f} ms")
+        backup.close()
+
+def bench_listing(args):
+    import web_viewer
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        posts = make_posts(args.posts, blog_name='febuiles')
+        for i in range(0, len(posts), 1000):
+            backup.save_posts(posts[i:i + 1000])
+        backup.close()
+
+        web_viewer.app.config['DATABASE'] = backup.db_path
+        client = web_viewer.app.test_client()
+        deep_page = min(args.page, args.posts // 20)
+        deep_post = posts[(deep_page - 1) * 20 - 1]
+        cases = [
+            ('page 1', '/'),
+            (f'page {deep_page} by offset', f'/?page={deep_page}'),
+            (f'page {deep_page} by cursor', f"/?before={deep_post['timestamp']}:{deep_post['id']}&page={deep_page}"),
+        ]
+        for label, url in cases:
+            client.get(url)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                client.get(url)
+            elapsed = (time.perf_counter() - start) / args.repeat * 1000
+            print(f"{label:<32} {elapsed:9.2f} ms")
+
+def bench_storage(args):
+    import web_viewer
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        posts = make_posts(args.posts, blog_name='febuiles')
+        for i in range(0, len(posts), 1000):
+            backup.save_posts(posts[i:i + 1000])
+        # Rewrite rows the way databases from before compression stored them.
+        conn = backup.get_connection()
+        conn.executemany('UPDATE posts SET raw_data = ? WHERE id = ?',
+                         [(json.dumps(post), post['id']) for post in posts])
+        conn.commit()
+        conn.execute('VACUUM')
+
+        web_viewer.app.config['DATABASE'] = backup.db_path
+        client = web_viewer.app.test_client()
+
+        def listing_ms():
+            client.get('/')
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                client.get('/?type=photo')
+            return (time.perf_counter() - start) / args.repeat * 1000
+
+        before = listing_ms()
+        logging.disable(logging.NOTSET)
+        backup.compress_raw_data()
+        logging.disable(logging.INFO)
+        after = listing_ms()
+        print(f"{'listing page':<32} {before:9.2f} ms -> {after:9.2f} ms")
+        backup.close()
+
+def bench_render(args):
+    import web_viewer
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        posts = make_posts(args.posts, blog_name='febuiles')
+        for i in range(0, len(posts), 1000):
+            backup.save_posts(posts[i:i + 1000])
+        backup.close()
+
+        web_viewer.app.config['DATABASE'] = backup.db_path
+        with web_viewer.app.app_context():
+            conn = web_viewer.get_db_connection()
+            cases = [
+                ('decode raw_data', """
+                    SELECT posts.id, posts.type, posts.summary, posts.raw_data FROM posts
+                    ORDER BY timestamp DESC, id DESC LIMIT 20 OFFSET ?
+                """),
+                ('post_render columns', f"""
+                    SELECT {web_viewer.LISTING_COLUMNS} FROM posts {web_viewer.LISTING_JOIN}
+                    ORDER BY posts.timestamp DESC, posts.id DESC LIMIT 20 OFFSET ?
+                """),
+            ]
+            for label, query in cases:
+                start = time.perf_counter()
+                for n in range(args.repeat):
+                    for post in conn.execute(query, ((n * 20) % args.posts,)).fetchall():
+                        web_viewer.format_post_content(post)
+                elapsed = (time.perf_counter() - start) / args.repeat * 1000
+                print(f"{label:<32} {elapsed:9.2f} ms per 20-post page")
+
+        client = web_viewer.app.test_client()
+        client.get('/')
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            client.get('/')
+        print(f"{'index page':<32} {(time.perf_counter() - start) / args.repeat * 1000:9.2f} ms")
+
+def bench_cache(args):
+    import web_viewer
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        posts = make_posts(args.posts, blog_name='febuiles')
+        for i in range(0, len(posts), 1000):
+            backup.save_posts(posts[i:i + 1000])
+        backup.close()
+
+        web_viewer.app.config['DATABASE'] = backup.db_path
+        client = web_viewer.app.test_client()
+        urls = ['/', '/?type=photo', f"/post/{posts[10]['id']}", '/stats', '/api/search?q=coffee']
+        for url in urls:
+            timings = []
+            for cache_bytes in (0, web_viewer.app.config['RESPONSE_CACHE_BYTES']):
+                web_viewer.app.config['RESPONSE_CACHE_BYTES'] = cache_bytes
+                etag = client.get(url).headers.get('ETag')
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    client.get(url)
+                timings.append((time.perf_counter() - start) / args.repeat * 1000)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                client.get(url, headers={'If-None-Match': etag})
+            revalidate = (time.perf_counter() - start) / args.repeat * 1000
+            print(f"{url:<32} uncached {timings[0]:7.2f} ms   cached {timings[1]:7.2f} ms   304 {revalidate:7.2f} ms")
+
+def bench_thumbnails(args):
+    from PIL import Image
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        conn = backup.get_connection()
+        rng = random.Random(0)
+        rows = []
+        for i in range(args.images):
+            image = Image.effect_mandelbrot((1280, 960), (rng.uniform(-2, 0), -1, rng.uniform(0, 1), 1), 50)
+            path = Path(workdir) / 'source.jpg'
+            image.convert('RGB').save(path, 'JPEG', quality=90)
+            digest = hashlib.sha256(path.read_bytes()).hexdigest()
+            object_path = backup.object_path(digest, '.jpg')
+            object_path.parent.mkdir(exist_ok=True)
+            os.replace(path, object_path)
+            rows.append((i, f'https://64.media.tumblr.com/{i}.jpg', str(object_path), digest))
+        conn.executemany('''
+            INSERT INTO media (post_id, media_url, local_path, digest, media_type, status, downloaded)
+            VALUES (?, ?, ?, ?, 'image', 'done', TRUE)
+        ''', rows)
+        conn.commit()
+        backup.derivative_formats = ['jpeg'] + args.formats.split(',') if args.formats else ['jpeg']
+        for workers in sorted({1, args.workers}):
+            conn.execute('DELETE FROM media_derivatives')
+            conn.commit()
+            start = time.perf_counter()
+            built = backup.generate_derivatives(max_workers=workers)
+            report(f'thumbnails ({workers} processes)', built, 'files', time.perf_counter() - start)
+        start = time.perf_counter()
+        backup.generate_derivatives()
+        print(f"{'rerun with nothing to do':<32} {time.perf_counter() - start:8.2f}s")
+        backup.close()
+
+def bench_verify(args):
+    from PIL import Image
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = new_backup(workdir)
+        conn = backup.get_connection()
+        rng = random.Random(0)
+        rows = []
+        for i in range(args.files):
+            path = Path(workdir) / 'source.jpg'
+            Image.effect_noise((320, 240), rng.uniform(16, 96)).save(path, 'JPEG', quality=85)
+            if i % 10 == 0:
+                # Bytes after the end-of-image marker, as some editors write; still a valid image.
+                with open(path, 'ab') as f:
+                    f.write(b'\0' * 512)
+            size = path.stat().st_size
+            digest = hashlib.sha256(path.read_bytes()).hexdigest()
+            object_path = backup.object_path(digest, '.jpg')
+            object_path.parent.mkdir(exist_ok=True)
+            os.replace(path, object_path)
+            local_path = backup.link_media(object_path, i, f'{i}.jpg')
+            rows.append((i, f'https://64.media.tumblr.com/{i}.jpg', local_path, digest, size))
+        conn.executemany('''
+            INSERT INTO media (post_id, media_url, local_path, digest, original_size, media_type, status, downloaded)
+            VALUES (?, ?, ?, ?, ?, 'image', 'done', TRUE)
+        ''', rows)
+        conn.commit()
+
+        damaged = rng.sample(rows, args.damage * 3)
+        truncated, deleted, unlinked = damaged[::3], damaged[1::3], damaged[2::3]
+        for post_id, _, local_path, digest, size in truncated:
+            os.truncate(backup.object_path(digest, '.jpg'), size // 2)
+        # No recorded size, so only decoding the image shows the damage.
+        conn.executemany('UPDATE media SET original_size = NULL WHERE post_id = ?',
+                         [(post_id,) for post_id, _, _, _, _ in truncated])
+        conn.commit()
+        for _, _, local_path, digest, _ in deleted:
+            os.remove(backup.object_path(digest, '.jpg'))
+            os.remove(local_path)
+        for _, _, local_path, _, _ in unlinked:
+            os.remove(local_path)
+        for i in range(args.damage):
+            orphan = backup.object_path(hashlib.sha256(str(i).encode()).hexdigest(), '.jpg')
+            orphan.parent.mkdir(exist_ok=True)
+            orphan.write_bytes(b'orphan')
+        print(f"{args.files} files: {len(truncated)} truncated, {len(deleted)} deleted, "
+              f"{len(unlinked)} per-post links removed, {args.damage} orphaned objects added")
+
+        # Every damaged file is logged as a warning; the counts below say the same.
+        logging.disable(logging.WARNING)
+        for label, hash_files in (('first verify', False), ('incremental verify', False),
+                                  ('verify --verify-hash', True), ('incremental --verify-hash', True)):
+            start = time.perf_counter()
+            checked, requeued, orphans = backup.verify_media(hash_files=hash_files, max_workers=args.workers)
+            seconds = time.perf_counter() - start
+            report(label, checked, 'files', seconds)
+            print(f"{'':<32} {requeued} requeued, {len(orphans)} orphans")
+        relinked = sum(os.path.exists(local_path) for _, _, local_path, _, _ in unlinked)
+        pending = conn.execute("SELECT COUNT(*) FROM media WHERE status = 'pending'").fetchone()[0]
+        quarantined = len(list(backup.quarantine_dir.iterdir())) if backup.quarantine_dir.exists() else 0
+        print(f"links restored {relinked}/{len(unlinked)}, rows pending download {pending}/"
+              f"{len(truncated) + len(deleted)}, files quarantined {quarantined}/{len(truncated)}")
+        backup.close()
+
+def write_until_stopped(workdir, journal_mode, workload, first_index, rate, ready, stop, written):
+    """Run a write workload in its own process until stopped
+
+    'ingest' saves 100-post batches at a fixed rate, so both journal modes
+    see the same load; 'rebuild' repeats rebuild-search-index, one long
+    transaction per pass.
+    """
+    backup = new_backup(workdir)
+    conn = backup.get_connection()
+    conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+    ready.set()
+    index = first_index
+    start = time.monotonic()
+    while not stop.is_set():
+        if workload == 'rebuild':
+            index += backup.rebuild_search_index()
+            continue
+        backup.save_posts([make_post('febuiles', i, 10 ** 7) for i in range(index, index + 100)])
+        index += 100
+        stop.wait(max(0, start + (index - first_index) / rate - time.monotonic()))
+    written.value = index - first_index
+    backup.close()
+
+def bench_concurrency(args):
+    import web_viewer
+
+    web_viewer.app.config['RESPONSE_CACHE_BYTES'] = 0
+    urls = ['/', '/?type=photo', '/stats', '/api/search?q=coffee']
+    for journal_mode in ('delete', 'wal'):
+        with tempfile.TemporaryDirectory() as workdir:
+            backup = new_backup(workdir)
+            posts = [make_post('febuiles', i, 10 ** 7) for i in range(args.posts)]
+            for i in range(0, len(posts), 1000):
+                backup.save_posts(posts[i:i + 1000])
+            backup.close()
+            web_viewer.app.config['DATABASE'] = backup.db_path
+
+            ready, stop = multiprocessing.Event(), multiprocessing.Event()
+            written = multiprocessing.Value('i', 0)
+            writer = multiprocessing.Process(target=write_until_stopped,
+                                             args=(workdir, journal_mode, args.writer, args.posts,
+                                                   args.write_rate, ready, stop, written))
+            writer.start()
+            ready.wait()
+
+            latencies = []
+            errors = []
+
+            def read(n):
+                client = web_viewer.app.test_client()
+                deadline = time.monotonic() + args.seconds
+                while time.monotonic() < deadline:
+                    url = urls[n % len(urls)]
+                    n += 1
+                    start = time.perf_counter()
+                    try:
+                        status = client.get(url).status_code
+                    except Exception as e:
+                        status = type(e).__name__
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    if status != 200:
+                        errors.append(status)
+
+            threads = [threading.Thread(target=read, args=(n,)) for n in range(args.readers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            stop.set()
+            writer.join()
+
+            latencies.sort()
+            p99 = latencies[int(len(latencies) * 0.99)]
+            print(f"{journal_mode.upper():<7} reads {len(latencies) / args.seconds:7.1f}/s  "
+                  f"p50 {statistics.median(latencies):7.2f} ms  p99 {p99:8.2f} ms  max {latencies[-1]:8.2f} ms  "
+                  f"errors {len(errors)}  writer {written.value / args.seconds:7.1f} posts/s")
+            if errors:
+                print(f"        {dict(Counter(map(str, errors)))}")
+
+def bench_backup(args):
+    settings = {
+        'blogs': {f'benchblog{n}': args.posts for n in range(args.blogs)},
+        'media_size': args.media_size,
+        'api_latency': args.api_latency,
+        'offset_latency': args.offset_latency,
+        'cdn_latency': args.cdn_latency,
+        'throttle_rate': args.throttle_rate,
+        'error_rate': args.error_rate,
+        'drop_rate': args.drop_rate,
+        'retry_after': args.retry_after,
+    }
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_fake_tumblr, args=(settings, ports), daemon=True)
+    server.start()
+    api_host = f'http://127.0.0.1:{ports.get()}'
+
+    # authenticate() reads these, exactly as on a real run.
+    os.environ['TUMBLR_CONSUMER_KEY'] = os.environ['TUMBLR_CONSUMER_SECRET'] = 'bench'
+    Path('.tumblr_tokens').write_text(json.dumps({'access_token': 'bench', 'access_token_secret': 'bench'}))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backup = TumblrBackup(
+            blog_workers=args.blog_workers, requests_per_hour=0, requests_per_day=0,
+            db_path=str(Path(workdir) / 'tumblr_backup.db'), media_dir=str(Path(workdir) / 'media'),
+            media_workers=args.media_workers, api_host=api_host, pipeline=args.pipeline and not args.skip_media,
+            resolution=args.resolution
+        )
+        backup.retrier.base_delay = args.base_delay
+        if not backup.authenticate():
+            raise SystemExit('Could not authenticate against the fake API')
+
+        page_ms = []
+        fetch_page = backup.client.posts
+
+        def timed_posts(*posts_args, **posts_kwargs):
+            start = time.perf_counter()
+            try:
+                return fetch_page(*posts_args, **posts_kwargs)
+            finally:
+                page_ms.append((time.perf_counter() - start) * 1000)
+
+        backup.client.posts = timed_posts
+        blogs = backup.get_user_blogs()
+        start = time.perf_counter()
+        _, stored = backup.backup_blogs(blogs)
+        elapsed = time.perf_counter() - start
+        report(f"backup_blogs ({len(blogs)} blogs{', pipelined' if backup.pipeline else ''})",
+               stored, 'posts', elapsed)
+        p50, p99 = percentiles(page_ms)
+        print(f"{'':<32} {len(page_ms)} API pages, p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+        tenth = max(len(page_ms) // 10, 1)
+        print(f"{'':<32} p50 of the first 10% of pages {percentiles(page_ms[:tenth])[0]:.2f} ms, "
+              f"last 10% {percentiles(page_ms[-tenth:])[0]:.2f} ms")
+        backup.ensure_raw_data_dictionary()
+
+        if args.grow:
+            requests.get(f'{api_host}/v2/bench/blogs', params={blog: args.posts + args.grow for blog in blogs})
+            pages = len(page_ms)
+            start = time.perf_counter()
+            _, stored = backup.backup_blogs(blogs)
+            report(f'incremental, {args.grow} new per blog', stored, 'posts', time.perf_counter() - start)
+            print(f"{'':<32} {len(page_ms) - pages} API pages, "
+                  f"{len(blogs) * args.grow - stored} new posts missed")
+
+        if not args.skip_media:
+            if not backup.pipeline:
+                start = time.perf_counter()
+                backup.download_all_media()
+                elapsed = time.perf_counter() - start
+            conn = backup.get_connection()
+            files, size = conn.execute(
+                "SELECT COUNT(*), TOTAL(original_size) FROM media WHERE status = 'done'").fetchone()
+            report('media, overlapped with paging' if backup.pipeline else 'download_all_media', files, 'files', elapsed)
+            print(f"{'':<32} {size / 1e6:.1f} MB at {size / 1e6 / elapsed:.1f} MB/s")
+            savings = backup.resolution_report()
+            if savings:
+                files, downloaded, as_originals = savings
+                print(f"{'':<32} {files} photos below original: {downloaded / 1e6:.1f} MB instead of "
+                      f"~{as_originals / 1e6:.1f} MB")
+        backup.close()
+        summary = backup.metrics.summary()
+        for name in ('tumblr_api_request_seconds', 'tumblr_db_transaction_seconds'):
+            for label, value in summary.get(name, {}).items():
+                title = f"{name.split('_')[1]} {label.split('=')[-1]}"
+                print(f"{title:<32} {value['count']:>6}  mean {value['mean'] * 1000:7.2f} ms  "
+                      f"p99 <= {value['p99'] * 1000:g} ms")
+        retries = sum(summary.get('tumblr_retries_total', {}).values())
+        waited = sum(summary.get('tumblr_rate_limit_wait_seconds_total', {}).values())
+        print(f"{'retries / rate-limit wait':<32} {retries:>6}  {waited:.2f}s")
+
+        import web_viewer
+        web_viewer.app.config['DATABASE'] = backup.db_path
+        web_viewer.app.config['MEDIA_FOLDER'] = str(backup.media_dir)
+        web_viewer.app.config['RESPONSE_CACHE_BYTES'] = 0
+        client = web_viewer.app.test_client()
+        blog = blogs[0]
+        post_id = make_post(blog, args.posts // 2, args.posts)['id']
+        routes = [f'/?blog={blog}', f'/?blog={blog}&type=photo', f'/post/{post_id}', '/stats', '/api/search?q=coffee']
+        for route in routes:
+            timings = []
+            for _ in range(args.viewer_requests):
+                start = time.perf_counter()
+                status = client.get(route).status_code
+                timings.append((time.perf_counter() - start) * 1000)
+            p50, p99 = percentiles(timings)
+            print(f"{route[:32]:<32} {status}  p50 {p50:7.2f} ms  p99 {p99:7.2f} ms")
+        exposition = client.get('/metrics').get_data(as_text=True)
+        print(f"{'/metrics':<32} {sum(not line.startswith('#') for line in exposition.splitlines())} samples")
+
+    print(f"{'peak RSS':<32} {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    server.terminate()
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for tumblr_backup.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    ingest = subparsers.add_parser('ingest', help='post ingestion throughput on synthetic posts')
+    ingest.add_argument('--posts', type=int, default=100000)
+    ingest.add_argument('--pages-per-batch', type=int, default=1)
+    ingest.set_defaults(func=bench_ingest)
+
+    media = subparsers.add_parser('media', help='media download throughput against a local HTTP server')
+    media.add_argument('--files', type=int, default=2000)
+    media.add_argument('--size', type=int, default=50000, help='bytes per file')
+    media.add_argument('--workers', type=int, default=5)
+    media.add_argument('--chunk-size', type=int, default=64 * 1024)
+    media.set_defaults(func=bench_media)
+
+    backlog = subparsers.add_parser('backlog', help='download_all_media over a large backlog, optionally from concurrent runs')
+    backlog.add_argument('--rows', type=int, default=100000)
+    backlog.add_argument('--size', type=int, default=1000, help='bytes per file')
+    backlog.add_argument('--workers', type=int, default=5)
+    backlog.add_argument('--runs', type=int, default=1, help='concurrent download_all_media processes')
+    backlog.set_defaults(func=bench_backlog)
+
+    hosts = subparsers.add_parser('hosts', help='images on a fast CDN queued behind videos on a slow host, '
+                                                'flat pool vs per-host limits and size ordering')
+    hosts.add_argument('--images', type=int, default=2000)
+    hosts.add_argument('--image-size', type=int, default=50000)
+    hosts.add_argument('--videos', type=int, default=20)
+    hosts.add_argument('--video-size', type=int, default=5000000)
+    hosts.add_argument('--video-rate', type=int, default=2000000, help='bytes/s per connection from the video host')
+    hosts.add_argument('--workers', type=int, default=5)
+    hosts.add_argument('--host-workers', type=int, default=2)
+    hosts.add_argument('--max-bandwidth', type=byte_rate, default=None, help='e.g. 20M')
+    hosts.set_defaults(func=bench_hosts)
+
+    faults = subparsers.add_parser('faults', help='media downloads against a server injecting 429/503/dropped connections')
+    faults.add_argument('--posts', type=int, default=500)
+    faults.add_argument('--size', type=int, default=200000, help='bytes per file')
+    faults.add_argument('--throttle-rate', type=float, default=0.1)
+    faults.add_argument('--error-rate', type=float, default=0.1)
+    faults.add_argument('--drop-rate', type=float, default=0.1)
+    faults.add_argument('--retry-after', type=int, default=1)
+    faults.add_argument('--base-delay', type=float, default=0.1, help='retry backoff base in seconds')
+    faults.set_defaults(func=bench_faults)
+
+    search = subparsers.add_parser('search', help='viewer search latency, LIKE scan vs the FTS5 index')
+    search.add_argument('--posts', type=int, default=100000)
+    search.add_argument('--repeat', type=int, default=5)
+    search.set_defaults(func=bench_search)
+
+    listing = subparsers.add_parser('listing', help='viewer index page latency, shallow vs deep pages')
+    listing.add_argument('--posts', type=int, default=100000)
+    listing.add_argument('--page', type=int, default=2000)
+    listing.add_argument('--repeat', type=int, default=20)
+    listing.set_defaults(func=bench_listing)
+
+    storage = subparsers.add_parser('storage', help='raw_data size and listing latency before/after compress-raw-data')
+    storage.add_argument('--posts', type=int, default=50000)
+    storage.add_argument('--repeat', type=int, default=20)
+    storage.set_defaults(func=bench_storage)
+
+    render = subparsers.add_parser('render', help='listing page formatting, raw_data decode vs post_render')
+    render.add_argument('--posts', type=int, default=20000)
+    render.add_argument('--repeat', type=int, default=200)
+    render.set_defaults(func=bench_render)
+
+    cache = subparsers.add_parser('cache', help='viewer pages rendered vs served from the response cache')
+    cache.add_argument('--posts', type=int, default=20000)
+    cache.add_argument('--repeat', type=int, default=200)
+    cache.set_defaults(func=bench_cache)
+
+    thumbnails = subparsers.add_parser('thumbnails', help='thumbnail generation on one process vs a pool')
+    thumbnails.add_argument('--images', type=int, default=200)
+    thumbnails.add_argument('--workers', type=int, default=os.cpu_count())
+    thumbnails.add_argument('--formats', default='webp', help='extra formats besides JPEG')
+    thumbnails.set_defaults(func=bench_thumbnails)
+
+    verify = subparsers.add_parser('verify', help='verify over a damaged archive, then again incrementally')
+    verify.add_argument('--files', type=int, default=5000)
+    verify.add_argument('--damage', type=int, default=20, help='files truncated, deleted, unlinked and orphaned each')
+    verify.add_argument('--workers', type=int, default=None)
+    verify.set_defaults(func=bench_verify)
+
+    concurrency = subparsers.add_parser('concurrency', help='viewer reads while a backup ingests, rollback journal vs WAL')
+    concurrency.add_argument('--posts', type=int, default=20000)
+    concurrency.add_argument('--readers', type=int, default=4)
+    concurrency.add_argument('--seconds', type=float, default=10)
+    concurrency.add_argument('--writer', choices=['ingest', 'rebuild'], default='ingest',
+                             help='backup workload running alongside: batched ingest or rebuild-search-index')
+    concurrency.add_argument('--write-rate', type=int, default=200, help='posts saved per second by the ingest writer')
+    concurrency.set_defaults(func=bench_concurrency)
+
+    backup = subparsers.add_parser('backup', help='end-to-end backup and viewer against a fake Tumblr API and CDN')
+    backup.add_argument('--blogs', type=int, default=2)
+    backup.add_argument('--posts', type=int, default=10000, help='posts per blog')
+    backup.add_argument('--media-size', type=int, default=20000, help='bytes per media file')
+    backup.add_argument('--skip-media', action='store_true', help='only fetch posts')
+    backup.add_argument('--grow', type=int, default=0,
+                        help='then add this many posts to the top of each blog and run again incrementally')
+    backup.add_argument('--pipeline', action='store_true', help='download media while paging, as --pipeline does')
+    backup.add_argument('--resolution', type=resolution, default=('original', None), help='e.g. max:640')
+    backup.add_argument('--blog-workers', type=int, default=4)
+    backup.add_argument('--media-workers', type=int, default=5)
+    backup.add_argument('--api-latency', type=float, default=0.0, help='seconds added to every API response')
+    backup.add_argument('--offset-latency', type=float, default=0.0,
+                        help='seconds added per 1000 posts of offset, as deep offsets slow down on Tumblr')
+    backup.add_argument('--cdn-latency', type=float, default=0.0, help='seconds added to every media response')
+    backup.add_argument('--throttle-rate', type=float, default=0.0)
+    backup.add_argument('--error-rate', type=float, default=0.0)
+    backup.add_argument('--drop-rate', type=float, default=0.0)
+    backup.add_argument('--retry-after', type=int, default=1)
+    backup.add_argument('--base-delay', type=float, default=0.1, help='retry backoff base in seconds')
+    backup.add_argument('--viewer-requests', type=int, default=50, help='requests per viewer route')
+    backup.set_defaults(func=bench_backup)
+
+    args = parser.parse_args()
+    # TumblrBackup logs to backup.log in the working directory.
+    os.chdir(tempfile.mkdtemp(prefix='tumblr-bench-'))
+    logging.disable(logging.INFO)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -4,29 +4,1114 @@ import os
 import sqlite3
 import logging
 import json
+import argparse
+import threading
+import queue
 import requests
+from requests.adapters import HTTPAdapter
 import mimetypes
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+import urllib.parse
 from urllib.parse import urlparse
 import hashlib
+import heapq
+import html
+import itertools
+import re
+import random
+import shutil
+import struct
 import time
+import uuid
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import closing, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 import pytumblr
+from pytumblr.request import TumblrRequest
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
 
 load_dotenv()
 
+# Tumblr's documented per-consumer-key API limits.
+DEFAULT_REQUESTS_PER_HOUR = 1000
+DEFAULT_REQUESTS_PER_DAY = 5000
+
+DEFAULT_MEDIA_WORKERS = 5
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_MEDIA_QUEUE_SIZE = 500
+# Seconds a run holds the media rows it claimed; renewed while it is alive.
+MEDIA_LEASE_SECONDS = 600
+
+# Order queued downloads are started in. Sizes come from a HEAD request's
+# Content-Length with --probe-sizes, otherwise from these rough guesses
+# (photos scaled by their pixel count).
+DOWNLOAD_ORDERS = ('fifo', 'small-first', 'large-first')
+TYPICAL_MEDIA_SIZES = {'image': 250 * 1024, 'audio': 5 * 1024 * 1024, 'video': 20 * 1024 * 1024}
+
+# Responses worth another try; anything else is returned to the caller.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# posts.raw_data is stored as a raw deflate stream behind a one byte tag,
+# optionally primed with a preset dictionary trained on this archive's own
+# posts. Rows written before compression are plain JSON text.
+RAW_ZLIB = b'\x00'
+RAW_ZLIB_DICT = b'\x01'
+RAW_DICT_SIZE = 32 * 1024
+RAW_DICT_SAMPLE = 2000
+
+# Listing thumbnails: images are scaled to fit a square of this many pixels,
+# always as JPEG and optionally in these extra formats as well.
+DEFAULT_THUMBNAIL_SIZE = 400
+DERIVATIVE_FORMATS = {'jpeg': ('JPEG', '.jpg'), 'webp': ('WEBP', '.webp'), 'avif': ('AVIF', '.avif')}
+
+# Images and videos embedded in post HTML (text bodies, captions, ...).
+INLINE_MEDIA = re.compile(r'''<(img|video|source)\b[^>]*?\ssrc=(["'])(https?://.*?)\2''', re.IGNORECASE)
+INLINE_MEDIA_FIELDS = ('body', 'caption', 'description', 'source', 'answer')
+
+# Media row as extract_media_urls describes it. variant is 'original' or
+# the width of the copy chosen by the resolution policy ('1280w'), variants
+# the photo's available sizes as JSON [width, height, url], original first.
+MEDIA_INSERT = '''
+    INSERT INTO media (post_id, media_url, media_type, width, height, variant, variants, original_url)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+MEDIA_TYPES = ('image', 'video', 'audio')
+
+# Stay under SQLite's default limit on host parameters per statement.
+SQL_BATCH_SIZE = 500
+
+def html_to_text(value):
+    text = re.sub(r'<[^>]+>', ' ', value or '')
+    return ' '.join(html.unescape(text).split())
+
+def extract_search_text(post):
+    """Return the (title, body, tags, summary) columns indexed in posts_fts"""
+    parts = [
+        post.get('body'),
+        post.get('caption'),
+        post.get('text') if post.get('type') == 'quote' else None,
+        post.get('source'),
+        post.get('description'),
+    ]
+    parts.extend(line.get('phrase') for line in post.get('dialogue') or [])
+    parts.extend(photo.get('caption') for photo in post.get('photos') or [])
+    body = ' '.join(html_to_text(part) for part in parts if part)
+    return (
+        html_to_text(post.get('title')),
+        body,
+        ' '.join(post.get('tags') or []),
+        post.get('summary') or ''
+    )
+
+# Per-type display fields the viewer's listing renders, stored in
+# post_render so pages never have to decode raw_data.
+RENDER_COLUMNS = ('title', 'body', 'quote', 'source', 'link_url', 'description',
+                  'chat', 'photos', 'video_url', 'audio_url')
+RENDER_INSERT = (f'INSERT INTO post_render (post_id, {", ".join(RENDER_COLUMNS)}) '
+                 f'VALUES ({", ".join("?" * (len(RENDER_COLUMNS) + 1))})')
+
+def extract_render_fields(post):
+    """Return the display fields for a post as a dict keyed by RENDER_COLUMNS"""
+    post_type = post.get('type')
+    fields = dict.fromkeys(RENDER_COLUMNS, '')
+    fields['chat'] = []
+    fields['photos'] = []
+
+    if post_type == 'text':
+        fields['title'] = post.get('title') or ''
+        fields['body'] = post.get('body') or ''
+    elif post_type == 'photo':
+        fields['photos'] = [
+            {
+                'url': photo['original_size']['url'],
+                'width': photo['original_size'].get('width'),
+                'height': photo['original_size'].get('height')
+            }
+            for photo in post.get('photos') or []
+            if (photo.get('original_size') or {}).get('url')
+        ]
+        fields['body'] = post.get('caption') or ''
+    elif post_type == 'quote':
+        fields['quote'] = post.get('text') or ''
+        fields['source'] = post.get('source') or ''
+    elif post_type == 'link':
+        fields['title'] = post.get('title') or ''
+        fields['link_url'] = post.get('url') or ''
+        fields['description'] = post.get('description') or ''
+    elif post_type == 'chat':
+        fields['title'] = post.get('title') or ''
+        fields['chat'] = [
+            {'name': line.get('name') or '', 'phrase': line.get('phrase') or ''}
+            for line in post.get('dialogue') or []
+        ]
+    elif post_type in ('video', 'audio'):
+        fields[f'{post_type}_url'] = post.get(f'{post_type}_url') or ''
+        fields['body'] = post.get('caption') or ''
+    return fields
+
+def render_row(post):
+    """Return a post_render row; lists are stored as compact JSON, empty fields as NULL"""
+    row = [post['id']]
+    for value in extract_render_fields(post).values():
+        if isinstance(value, list):
+            value = json.dumps(value, separators=(',', ':')) if value else None
+        row.append(value or None)
+    return tuple(row)
+
+def estimate_media_size(media_type, width=None, height=None):
+    if media_type == 'image' and width and height:
+        # About two bits per pixel for a typical JPEG.
+        return width * height // 4
+    return TYPICAL_MEDIA_SIZES.get(media_type, TYPICAL_MEDIA_SIZES['image'])
+
+def media_row(post_id, media):
+    return (post_id, media['url'], media['type'], media.get('width'), media.get('height'),
+            media.get('variant', 'original'), media.get('variants'), media.get('original_url', media['url']))
+
+def photo_variants(photo):
+    """A photo's original and alt sizes as (width, height, url), original first"""
+    variants = []
+    seen = set()
+    for size in [photo.get('original_size') or {}] + (photo.get('alt_sizes') or []):
+        url = size.get('url')
+        if url and url not in seen:
+            seen.add(url)
+            variants.append((size.get('width') or 0, size.get('height') or 0, url))
+    return variants
+
+def choose_variant(variants, policy):
+    """Pick the size a resolution policy asks for: the original, an exact alt width, or the largest within a width"""
+    kind, width = policy
+    if kind == 'original' or len(variants) == 1:
+        return variants[0]
+    if kind == 'alt':
+        for variant in variants:
+            if variant[0] == width:
+                return variant
+    fitting = [variant for variant in variants if variant[0] <= width]
+    if fitting:
+        return max(fitting, key=lambda variant: variant[0])
+    return min(variants, key=lambda variant: variant[0])
+
+def bump_generation(cursor):
+    """Mark the archive as changed; the viewer keys its response cache on this"""
+    cursor.execute("UPDATE db_meta SET value = value + 1 WHERE key = 'generation'")
+    cursor.execute("UPDATE db_meta SET value = ? WHERE key = 'updated_at'", (int(time.time()),))
+
+def build_derivative(source, target, size, image_format):
+    """Write source scaled to fit a size x size box to target; runs in a worker process"""
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        temp_path = f'{target}.tmp'
+        image.save(temp_path, image_format, quality=80)
+        os.replace(temp_path, target)
+        return image.width, image.height, os.path.getsize(target)
+
+def check_image(path):
+    """Why an image file fails to decode, or None; without Pillow nothing is checked"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as image:
+            image.load()
+    except Exception as e:
+        return f"unreadable image ({e})"
+    return None
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def check_media_file(path, expected_size, image, previous, digest=None, links=()):
+    """Check one stored file; runs in the verify pool
+
+    previous is the (size, mtime, hashed) recorded by the last verify, and
+    a file still matching it is only stat'ed. digest, when given, is
+    compared with the file's SHA-256. Returns (problem or None, stat,
+    links that are missing).
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return "missing", None, []
+    missing_links = [link for link in links if not os.path.exists(link)]
+    if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime and (previous[2] or not digest):
+        return None, stat, missing_links
+    if expected_size is not None and stat.st_size != expected_size:
+        return f"size {stat.st_size}, expected {expected_size}", stat, missing_links
+    if digest:
+        if hash_file(path) != digest:
+            return "content does not match its SHA-256", stat, missing_links
+    if image:
+        problem = check_image(path)
+        if problem:
+            return problem, stat, missing_links
+    return None, stat, missing_links
+
+def train_raw_data_dictionary(samples, size=RAW_DICT_SIZE):
+    """Build a deflate preset dictionary from sample post JSON strings
+
+    Keys, string values and URL prefixes that recur across posts are
+    scored by how often they appear times their length; the best ones go at
+    the end, where deflate can reach them with the shortest distances.
+    """
+    counts = Counter()
+    for sample in samples:
+        fragments = set(re.findall(r'"[^"\\]{1,64}": ?', sample))
+        fragments.update(re.findall(r'"[^"\\]{2,96}"[,}\]]', sample))
+        fragments.update(re.findall(r'https?://[^/"]+/', sample))
+        counts.update(fragments)
+
+    ranked = sorted(
+        (fragment for fragment, count in counts.items() if count > 1),
+        key=lambda fragment: counts[fragment] * len(fragment)
+    )
+    chosen = []
+    total = 0
+    for fragment in reversed(ranked):
+        encoded = fragment.encode()
+        if total + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        total += len(encoded)
+
+    # Whole sample posts fill any space left, in front of the fragments.
+    for sample in samples:
+        if total >= size:
+            break
+        encoded = sample.encode()[:size - total]
+        chosen.append(encoded)
+        total += len(encoded)
+    return b''.join(reversed(chosen))
+
+class RawDataCodec:
+    """Compresses posts.raw_data and decodes every stored format
+
+    Dictionaries live in raw_data_dicts and are loaded on first use, so
+    readers only need the database path.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.dicts = {}
+        self.current = None
+        self.lock = threading.Lock()
+
+    def load_current(self, conn):
+        # Called before every write, so a dictionary trained by another
+        # process is picked up by the next batch.
+        dict_id = conn.execute('SELECT MAX(id) FROM raw_data_dicts').fetchone()[0]
+        if dict_id is not None:
+            self.get_dict(dict_id, conn)
+        self.current = dict_id
+
+    def referenced_dicts(self, conn):
+        return {struct.unpack('>I', prefix)[0] for prefix, in conn.execute(
+            'SELECT DISTINCT substr(raw_data, 2, 4) FROM posts WHERE substr(raw_data, 1, 1) = ?', (RAW_ZLIB_DICT,))}
+
+    def get_dict(self, dict_id, conn=None):
+        with self.lock:
+            if dict_id in self.dicts:
+                return self.dicts[dict_id]
+        if conn is None:
+            with closing(sqlite3.connect(self.db_path)) as own_conn:
+                row = own_conn.execute('SELECT data FROM raw_data_dicts WHERE id = ?', (dict_id,)).fetchone()
+        else:
+            row = conn.execute('SELECT data FROM raw_data_dicts WHERE id = ?', (dict_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"Missing raw_data dictionary {dict_id}")
+        with self.lock:
+            self.dicts[dict_id] = row[0]
+        return row[0]
+
+    def encode(self, post):
+        data = json.dumps(post, separators=(',', ':')).encode()
+        if self.current is None:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+            header = RAW_ZLIB
+        else:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=self.dicts[self.current])
+            header = RAW_ZLIB_DICT + struct.pack('>I', self.current)
+        return header + compressor.compress(data) + compressor.flush()
+
+    def decode(self, value):
+        if not value:
+            return {}
+        if isinstance(value, str):
+            return json.loads(value)
+        tag = value[:1]
+        if tag == RAW_ZLIB:
+            return json.loads(zlib.decompress(value[1:], -15))
+        if tag == RAW_ZLIB_DICT:
+            dict_id, = struct.unpack('>I', value[1:5])
+            decompressor = zlib.decompressobj(-15, zdict=self.get_dict(dict_id))
+            return json.loads(decompressor.decompress(value[5:]) + decompressor.flush())
+        raise ValueError(f"Unknown raw_data format {tag!r}")
+
+# Everything a backup run records: name -> (type, help).
+BACKUP_METRICS = {
+    'tumblr_api_request_seconds': ('histogram', 'Tumblr API call latency, including retries'),
+    'tumblr_rate_limit_wait_seconds_total': ('counter', 'Time API calls spent waiting on the rate limiter'),
+    'tumblr_retries_total': ('counter', 'HTTP requests retried, by host and reason'),
+    'tumblr_posts_fetched_total': ('counter', 'Posts received from the API'),
+    'tumblr_posts_stored_total': ('counter', 'New posts written to the database'),
+    'tumblr_db_transaction_seconds': ('histogram', 'SQLite write transaction time, by operation'),
+    'tumblr_media_bytes_total': ('counter', 'Media bytes downloaded, by host'),
+    'tumblr_media_files_total': ('counter', 'Media rows finished, by status'),
+    'tumblr_media_pending': ('gauge', 'Media downloads queued or in flight'),
+    'tumblr_media_active': ('gauge', 'Media downloads in flight, by host'),
+    'tumblr_bandwidth_wait_seconds_total': ('counter', 'Time downloads were held back by bandwidth caps, by host'),
+    'tumblr_media_writer_queue_depth': ('gauge', 'Download results waiting to be written to the database'),
+}
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms in the Prometheus text format"""
+
+    def __init__(self, descriptions):
+        self.descriptions = descriptions
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, name, labels):
+        if name not in self.descriptions:
+            raise KeyError(f"Unknown metric {name}")
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = {'buckets': [0] * len(METRIC_BUCKETS), 'sum': 0.0,
+                                                 'count': 0, 'max': 0.0}
+            for i, bound in enumerate(METRIC_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            histogram['max'] = max(histogram['max'], value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: item[0])
+            values = [(key, dict(value, buckets=list(value['buckets'])) if isinstance(value, dict) else value)
+                      for key, value in values]
+
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            if name not in described:
+                kind, text = self.descriptions[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+                described.add(name)
+            if isinstance(value, dict):
+                for bound, count in zip(METRIC_BUCKETS, value['buckets']):
+                    lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {value['count']}")
+                lines.append(f"{name}_sum{label_text(labels)} {value['sum']}")
+                lines.append(f"{name}_count{label_text(labels)} {value['count']}")
+            else:
+                lines.append(f'{name}{label_text(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Current values as plain data; histograms as count, sum, mean, max and bucket-bound p50/p99"""
+        with self.lock:
+            items = list(self.values.items())
+        summary = {}
+        for (name, labels), value in sorted(items, key=lambda item: item[0]):
+            label = ','.join(f'{k}={v}' for k, v in labels) or 'total'
+            if isinstance(value, dict):
+                def quantile(q):
+                    for bound, count in zip(METRIC_BUCKETS, value['buckets']):
+                        if count >= q * value['count']:
+                            return bound
+                    return value['max']
+                value = {
+                    'count': value['count'],
+                    'sum': round(value['sum'], 6),
+                    'mean': round(value['sum'] / value['count'], 6) if value['count'] else 0.0,
+                    'max': round(value['max'], 6),
+                    'p50': quantile(0.5),
+                    'p99': quantile(0.99),
+                }
+            summary.setdefault(name, {})[label] = value
+        return summary
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the backup's metrics on /metrics"""
+
+    metrics = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class RateLimiter:
+    """Token bucket per window (hour, day) shared by every API-calling thread"""
+
+    def __init__(self, requests_per_hour=DEFAULT_REQUESTS_PER_HOUR, requests_per_day=DEFAULT_REQUESTS_PER_DAY):
+        self.lock = threading.Lock()
+        self.buckets = []
+        for limit, period in ((requests_per_hour, 3600), (requests_per_day, 86400)):
+            if limit:
+                self.buckets.append({'capacity': limit, 'rate': limit / period, 'tokens': float(limit)})
+        self.last_refill = time.monotonic()
+        # Extra spacing between calls, widened whenever the API throttles us
+        # and narrowed again as calls succeed.
+        self.interval = 0.0
+        self.next_call = 0.0
+
+    def throttle(self, pause):
+        with self.lock:
+            self.interval = min(max(self.interval * 2, 0.5), 30.0)
+            self.next_call = max(self.next_call, time.monotonic() + pause)
+
+    def recover(self):
+        with self.lock:
+            self.interval = self.interval * 0.9 if self.interval > 0.05 else 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        for bucket in self.buckets:
+            bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + elapsed * bucket['rate'])
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.refill()
+                now = time.monotonic()
+                empty = [b for b in self.buckets if b['tokens'] < 1]
+                if not empty and now >= self.next_call:
+                    for bucket in self.buckets:
+                        bucket['tokens'] -= 1
+                    self.next_call = now + self.interval
+                    return
+                wait = max([(1 - b['tokens']) / b['rate'] for b in empty] + [self.next_call - now])
+            time.sleep(wait)
+
+class BandwidthLimiter:
+    """Caps download throughput in bytes per second, overall and per host
+
+    Each cap is a bucket allowed to go into debt: a chunk is always taken,
+    and its reader then sleeps until the debt is paid back, so the long-run
+    rate holds without splitting reads.
+    """
+
+    def __init__(self, total_rate=None, host_rate=None, metrics=None, burst=1.0):
+        self.total_rate = total_rate
+        self.host_rate = host_rate
+        self.metrics = metrics
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def take(self, key, rate, amount, now):
+        tokens, last = self.buckets.get(key, (rate * self.burst, now))
+        tokens = min(rate * self.burst, tokens + (now - last) * rate) - amount
+        self.buckets[key] = (tokens, now)
+        return -tokens / rate if tokens < 0 else 0.0
+
+    def consume(self, host, amount):
+        with self.lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self.total_rate:
+                wait = self.take(None, self.total_rate, amount, now)
+            if self.host_rate:
+                wait = max(wait, self.take(host, self.host_rate, amount, now))
+        if wait > 0:
+            if self.metrics:
+                self.metrics.inc('tumblr_bandwidth_wait_seconds_total', wait, host=host)
+            time.sleep(wait)
+
+class Retrier:
+    """Retries HTTP requests with jittered exponential backoff
+
+    Retry-After is honored, and a host that keeps failing has its circuit
+    opened: every thread holds off that host until the cooldown ends, then a
+    single success closes it again.
+    """
+
+    def __init__(self, logger, max_retries=6, base_delay=1.0, max_delay=120.0,
+                 failure_threshold=5, cooldown=30.0, metrics=None):
+        self.logger = logger
+        self.metrics = metrics
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def host_state(self, host):
+        return self.hosts.setdefault(host, {'failures': 0, 'open_until': 0.0})
+
+    def wait_for_host(self, host):
+        with self.lock:
+            wait = self.host_state(host)['open_until'] - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def record_success(self, host):
+        with self.lock:
+            self.host_state(host)['failures'] = 0
+
+    def record_failure(self, host, pause):
+        with self.lock:
+            state = self.host_state(host)
+            state['failures'] += 1
+            if state['failures'] >= self.failure_threshold:
+                pause = max(pause, self.cooldown)
+                if state['failures'] == self.failure_threshold:
+                    self.logger.warning(f"Too many failures from {host}, pausing it for {pause:.0f}s")
+            state['open_until'] = max(state['open_until'], time.monotonic() + pause)
+
+    def retry_after(self, response):
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        if value.isdigit():
+            return float(value)
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def request(self, session, method, url, rate_limiter=None, **kwargs):
+        host = urlparse(url).netloc
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_host(host)
+            if rate_limiter:
+                start = time.perf_counter()
+                rate_limiter.acquire()
+                if self.metrics:
+                    self.metrics.inc('tumblr_rate_limit_wait_seconds_total', time.perf_counter() - start)
+
+            error = None
+            try:
+                response = session.request(method, url, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                response = None
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.record_success(host)
+                    if rate_limiter:
+                        rate_limiter.recover()
+                    return response
+
+            if attempt == self.max_retries:
+                if error:
+                    raise error
+                return response
+
+            delay = self.backoff(attempt)
+            host_pause = 0.0
+            if response is not None:
+                retry_after = self.retry_after(response)
+                if retry_after is not None:
+                    # The server asked everyone to wait, not just this thread.
+                    delay = host_pause = retry_after
+                if response.status_code == 429 and rate_limiter:
+                    rate_limiter.throttle(delay)
+                reason = f"HTTP {response.status_code}"
+                response.close()
+            else:
+                reason = type(error).__name__
+
+            self.record_failure(host, host_pause)
+            if self.metrics:
+                self.metrics.inc('tumblr_retries_total', host=host, reason=reason)
+            self.logger.warning(f"{reason} from {host}, retrying in {delay:.1f}s "
+                                f"(attempt {attempt + 1}/{self.max_retries})")
+            time.sleep(delay)
+
+class RetryingTumblrRequest(TumblrRequest):
+    """pytumblr's request layer routed through the shared retrier and rate limiter"""
+
+    def __init__(self, consumer_key, consumer_secret, oauth_token, oauth_secret, host,
+                 retrier, rate_limiter, session, metrics):
+        super().__init__(consumer_key, consumer_secret, oauth_token, oauth_secret, host)
+        self.retrier = retrier
+        self.metrics = metrics
+        self.rate_limiter = rate_limiter
+        self.session = session
+
+    def get(self, url, params):
+        url = self.host + url
+        if params:
+            url = url + "?" + urllib.parse.urlencode(params)
+
+        with self.metrics.time('tumblr_api_request_seconds', endpoint=url.split('?')[0].rsplit('/', 1)[-1]):
+            response = self.retrier.request(
+                self.session, 'GET', url,
+                rate_limiter=self.rate_limiter,
+                allow_redirects=False,
+                headers=self.headers,
+                auth=self.oauth,
+                timeout=30
+            )
+        return self.json_parse(response)
+
+class TumblrAPIError(Exception):
+    pass
+
+class MediaResultWriter:
+    """Records finished downloads from a queue in batched transactions
+
+    A batch is flushed once it holds batch_size results or flush_interval
+    seconds after its first result, so a crash loses at most one batch of
+    bookkeeping (those files are simply downloaded again next run). A batch
+    that fails to commit is kept and retried with backoff; meanwhile the
+    queue fills up to max_queued and download workers wait on put().
+    """
+
+    def __init__(self, db_path, logger, metrics, lease_owner=None, batch_size=200, flush_interval=2.0,
+                 max_queued=1000, close_retries=5):
+        self.db_path = db_path
+        self.logger = logger
+        self.metrics = metrics
+        self.lease_owner = lease_owner
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.close_retries = close_retries
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.thread = threading.Thread(target=self.run, name='media-writer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, media_id, result):
+        self.queue.put((media_id, result))
+        self.metrics.set('tumblr_media_writer_queue_depth', self.queue.qsize())
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def flush(self, conn, batch):
+        """Record batch in one transaction and empty it; on a database error it is kept for a retry"""
+        if not batch:
+            return True
+        done = []
+        failed = []
+        for media_id, result in batch:
+            if result['status'] == 'done':
+                done.append((result['local_path'], result['digest'], result['size'], media_id))
+            else:
+                failed.append((result['status'], result.get('error'), media_id))
+        try:
+            with conn, self.metrics.time('tumblr_db_transaction_seconds', operation='media_results'):
+                conn.executemany('''
+                    UPDATE media SET
+                        local_path = ?,
+                        digest = ?,
+                        original_size = ?,
+                        -- An upgraded row only becomes the original once it is stored.
+                        variant = CASE WHEN media_url = original_url THEN 'original' ELSE variant END,
+                        width = CASE WHEN media_url = original_url AND variant != 'original'
+                                     THEN json_extract(variants, '$[0][0]') ELSE width END,
+                        height = CASE WHEN media_url = original_url AND variant != 'original'
+                                      THEN json_extract(variants, '$[0][1]') ELSE height END,
+                        status = 'done',
+                        attempts = attempts + 1,
+                        last_error = NULL,
+                        downloaded = TRUE,
+                        lease_owner = NULL,
+                        lease_expires = NULL
+                    WHERE id = ?
+                ''', done)
+                conn.executemany('''
+                    UPDATE media SET
+                        status = ?,
+                        attempts = attempts + 1,
+                        last_error = ?,
+                        downloaded = local_path IS NOT NULL,
+                        lease_owner = NULL,
+                        lease_expires = NULL
+                    WHERE id = ?
+                ''', failed)
+                bump_generation(conn)
+        except sqlite3.Error as e:
+            self.logger.error(f"Failed to record {len(batch)} media results, will retry: {e}")
+            return False
+        batch.clear()
+        self.metrics.set('tumblr_media_writer_queue_depth', self.queue.qsize())
+        return True
+
+    def renew_leases(self, conn, expires):
+        try:
+            with conn:
+                conn.execute('UPDATE media SET lease_expires = ? WHERE lease_owner = ?', (expires, self.lease_owner))
+        except sqlite3.Error as e:
+            self.logger.error(f"Failed to renew media leases: {e}")
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        batch = []
+        deadline = None
+        failures = 0
+        # Rows claimed by this run stay leased to it until their result is
+        # recorded; a run that dies simply lets its leases run out.
+        renew_at = time.monotonic() + MEDIA_LEASE_SECONDS / 3 if self.lease_owner else None
+        while True:
+            wake = min(t for t in (deadline, renew_at, float('inf')) if t is not None)
+            timeout = None if wake == float('inf') else max(0, wake - time.monotonic())
+            if failures and len(batch) >= self.batch_size:
+                # Leave results in the queue, so a full one holds back the
+                # workers instead of the batch growing without bound.
+                time.sleep(timeout)
+                item = False
+            else:
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = False
+
+            if renew_at is not None and time.monotonic() >= renew_at:
+                self.renew_leases(conn, time.time() + MEDIA_LEASE_SECONDS)
+                renew_at = time.monotonic() + MEDIA_LEASE_SECONDS / 3
+
+            if item:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+
+            # While a failed batch waits for its retry, only the deadline
+            # triggers a flush, however large the batch grows.
+            full = len(batch) >= self.batch_size and not failures
+            if item is None or full or (deadline and time.monotonic() >= deadline):
+                if self.flush(conn, batch):
+                    deadline = None
+                    failures = 0
+                else:
+                    failures += 1
+                    deadline = time.monotonic() + min(2 ** failures, 60)
+
+            if item is None:
+                while batch and failures <= self.close_retries:
+                    time.sleep(min(2 ** failures, 60))
+                    failures += 1
+                    self.flush(conn, batch)
+                if batch:
+                    self.logger.error(f"Gave up recording {len(batch)} media results; their rows are "
+                                      f"downloaded again once their leases expire")
+                break
+        if self.lease_owner:
+            # Whatever was claimed but never attempted is free for the next run.
+            with conn:
+                conn.execute('UPDATE media SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = ?',
+                             (self.lease_owner,))
+        conn.close()
+
+class DownloadScheduler:
+    """Bounded queue of downloads, handed out per host and in priority order
+
+    A worker gets the most urgent download among hosts that are below
+    host_workers active downloads, so one slow host holding videos cannot
+    take every worker while images for another host wait.
+    """
+
+    def __init__(self, capacity, host_workers=None, metrics=None):
+        self.capacity = capacity
+        self.host_workers = host_workers
+        self.metrics = metrics
+        self.cond = threading.Condition()
+        self.hosts = {}
+        self.active = Counter()
+        self.size = 0
+        self.closed = False
+        self.sequence = itertools.count()
+
+    def put(self, host, priority, item):
+        with self.cond:
+            while self.size >= self.capacity:
+                self.cond.wait()
+            heapq.heappush(self.hosts.setdefault(host, []), (priority, next(self.sequence), item))
+            self.size += 1
+            self.cond.notify_all()
+
+    def get(self):
+        """Next (host, item) to download, or None once closed and drained"""
+        with self.cond:
+            while True:
+                ready = [(heap[0], host) for host, heap in self.hosts.items()
+                         if not self.host_workers or self.active[host] < self.host_workers]
+                if ready:
+                    _, host = min(ready)
+                    _, _, item = heapq.heappop(self.hosts[host])
+                    if not self.hosts[host]:
+                        del self.hosts[host]
+                    self.size -= 1
+                    self.active[host] += 1
+                    if self.metrics:
+                        self.metrics.set('tumblr_media_active', self.active[host], host=host)
+                    self.cond.notify_all()
+                    return host, item
+                if self.closed and not self.size:
+                    return None
+                self.cond.wait()
+
+    def done(self, host):
+        with self.cond:
+            self.active[host] -= 1
+            if self.metrics:
+                self.metrics.set('tumblr_media_active', self.active[host], host=host)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class MediaPipeline:
+    """Downloads media on worker threads as rows are handed to it
+
+    submit() blocks while queue_size URLs are already waiting, holding back
+    whoever feeds it (the blog pagers, with --pipeline) so memory stays flat
+    however far ahead pagination could run. A URL that is queued, in flight
+    or recently finished is fetched once for all the rows that share it.
+    Queued URLs are started in the backup's download_order, at most
+    host_workers at a time per host.
+    """
+
+    def __init__(self, backup, workers, queue_size=DEFAULT_MEDIA_QUEUE_SIZE, first_id=0, recent=10000):
+        self.backup = backup
+        self.first_id = first_id
+        self.scheduler = DownloadScheduler(queue_size, backup.host_workers, backup.metrics)
+        probing = backup.probe_sizes and backup.download_order != 'fifo'
+        self.prober = ThreadPoolExecutor(max_workers=workers) if probing else None
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.finished = OrderedDict()
+        self.recent = recent
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.writer = MediaResultWriter(backup.db_path, backup.logger, backup.metrics, backup.lease_owner)
+        self.threads = [threading.Thread(target=self.run, name=f'media-{n}', daemon=True) for n in range(workers)]
+
+    def start(self):
+        if self.backup.session is not None:
+            self.backup.session.close()
+        # Size probes run alongside the downloads, on the same session.
+        self.backup.session = self.backup.create_session(len(self.threads) * (2 if self.prober else 1))
+        self.writer.start()
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def known_result(self, digest, known_path):
+        if not (digest and known_path):
+            return None
+        filename = Path(known_path).name
+        object_path = self.backup.object_path(digest, Path(filename).suffix)
+        if not object_path.exists():
+            return None
+        return {
+            'status': 'done',
+            'object_path': object_path,
+            'filename': filename,
+            'digest': digest,
+            'size': object_path.stat().st_size
+        }
+
+    def priority(self, entry):
+        order = self.backup.download_order
+        if order == 'small-first':
+            return entry['size']
+        if order == 'large-first':
+            return -entry['size']
+        return 0
+
+    def submit(self, rows):
+        """Queue media rows as returned by TumblrBackup.pending_media"""
+        queued = []
+        for media_id, post_id, url, media_type, width, height, digest, known_path in rows:
+            result = self.known_result(digest, known_path)
+            with self.lock:
+                self.submitted += 1
+                result = result or self.finished.get(url)
+                if result is None:
+                    entry = self.entries.get(url)
+                    if entry is not None:
+                        entry['rows'].append((media_id, post_id))
+                        continue
+                    entry = self.entries[url] = {'type': media_type, 'rows': [(media_id, post_id)],
+                                                 'size': estimate_media_size(media_type, width, height)}
+                self.backup.metrics.set('tumblr_media_pending', len(self.entries))
+            if result is not None:
+                self.record(result, [(media_id, post_id)])
+            else:
+                queued.append((url, entry))
+
+        if self.prober:
+            sizes = self.prober.map(self.backup.probe_size, [url for url, _ in queued])
+            for (_, entry), size in zip(queued, sizes):
+                if size is not None:
+                    entry['size'] = size
+        for url, entry in queued:
+            self.scheduler.put(urlparse(url).netloc, self.priority(entry), (url, entry))
+
+    def record(self, result, rows):
+        for media_id, post_id in rows:
+            if result['status'] == 'done':
+                result = dict(result, local_path=self.backup.link_media(result['object_path'], post_id,
+                                                                        result['filename']))
+            self.writer.put(media_id, result)
+            self.backup.metrics.inc('tumblr_media_files_total', status=result['status'])
+            with self.lock:
+                self.completed += 1
+                self.failed += result['status'] != 'done'
+                if self.completed % 10 == 0:
+                    self.backup.logger.info(f"Downloaded {self.completed}/{self.submitted} files")
+
+    def run(self):
+        while True:
+            item = self.scheduler.get()
+            if item is None:
+                break
+            host, (url, entry) = item
+            try:
+                result = self.backup.download_media(url, entry['rows'][0][1], entry['type'])
+            except Exception as e:
+                result = {'status': 'failed', 'error': str(e)}
+            finally:
+                self.scheduler.done(host)
+            # Once the entry is gone no more rows can join it, and later rows
+            # for this URL reuse the result instead of fetching it again.
+            with self.lock:
+                del self.entries[url]
+                self.finished[url] = result
+                if len(self.finished) > self.recent:
+                    self.finished.popitem(last=False)
+                self.backup.metrics.set('tumblr_media_pending', len(self.entries))
+            self.record(result, entry['rows'])
+
+    def close(self):
+        self.scheduler.close()
+        for thread in self.threads:
+            thread.join()
+        if self.prober:
+            self.prober.shutdown()
+        self.writer.close()
+        return self.completed, self.failed
+
 class TumblrBackup:
-    def __init__(self):
+    def __init__(self, blog_workers=4, requests_per_hour=DEFAULT_REQUESTS_PER_HOUR,
+                 requests_per_day=DEFAULT_REQUESTS_PER_DAY, db_path='tumblr_backup.db', media_dir='media',
+                 media_workers=DEFAULT_MEDIA_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, thumbnail_size=DEFAULT_THUMBNAIL_SIZE,
+                 derivative_formats=(), thumbnail_workers=None, api_host=None,
+                 metrics_port=None, metrics_path='backup_metrics.json', pipeline=False,
+                 media_queue_size=DEFAULT_MEDIA_QUEUE_SIZE, host_workers=None, download_order='fifo',
+                 probe_sizes=False, max_bandwidth=None, host_bandwidth=None, resolution=('original', None),
+                 resolution_overrides=(), verify_workers=None):
         self.consumer_key = os.getenv('TUMBLR_CONSUMER_KEY')
         self.consumer_secret = os.getenv('TUMBLR_CONSUMER_SECRET')
         self.access_token = None
         self.access_token_secret = None
         self.client = None
-        self.db_path = 'tumblr_backup.db'
-        self.media_dir = Path('media')
+        self.api_host = api_host
+        self.db_path = db_path
+        self.media_dir = Path(media_dir)
+        self.objects_dir = self.media_dir / 'objects'
+        self.derivatives_dir = self.media_dir / 'derivatives'
+        self.quarantine_dir = self.media_dir / 'quarantine'
+        self.codec = RawDataCodec(self.db_path)
+        self.blog_workers = blog_workers
+        self.rate_limiter = RateLimiter(requests_per_hour, requests_per_day)
+        self.db_lock = threading.Lock()
+        self.conn = None
+        self.tag_ids = {}
+        self.media_workers = media_workers
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.thumbnail_size = thumbnail_size
+        self.derivative_formats = ['jpeg'] + [f for f in derivative_formats if f != 'jpeg']
+        self.thumbnail_workers = thumbnail_workers
+        self.session = None
+        self.pipeline = pipeline
+        self.media_queue_size = media_queue_size
+        self.media_pipeline = None
+        self.host_workers = host_workers
+        self.download_order = download_order
+        self.probe_sizes = probe_sizes
+        self.resolution = resolution
+        self.resolution_overrides = dict(resolution_overrides)
+        self.verify_workers = verify_workers or min(32, (os.cpu_count() or 1) * 4)
+        self.lease_owner = uuid.uuid4().hex
+        self.metrics = Metrics(BACKUP_METRICS)
+        self.metrics_port = metrics_port
+        self.metrics_path = metrics_path
         self.setup_logging()
+        self.retrier = Retrier(self.logger, metrics=self.metrics)
+        self.bandwidth = (BandwidthLimiter(max_bandwidth, host_bandwidth, self.metrics)
+                          if max_bandwidth or host_bandwidth else None)
         self.setup_directories()
         self.setup_database()
 
@@ -43,11 +1128,17 @@ class TumblrBackup:
 
     def setup_directories(self):
         self.media_dir.mkdir(exist_ok=True)
+        self.objects_dir.mkdir(exist_ok=True)
+        self.derivatives_dir.mkdir(exist_ok=True)
 
     def setup_database(self):
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
+        # WAL lets the viewer keep reading while a backup writes; the mode
+        # is stored in the database file, so this only has to happen once.
+        cursor.execute('PRAGMA journal_mode = WAL')
+
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS posts (
                 id INTEGER PRIMARY KEY,
@@ -100,9 +1191,331 @@ class TumblrBackup:
             )
         ''')
 
+        added = self.add_missing_columns(cursor, 'media', {
+            'digest': 'TEXT',
+            'status': "TEXT NOT NULL DEFAULT 'pending'",
+            'attempts': 'INTEGER NOT NULL DEFAULT 0',
+            'last_error': 'TEXT',
+            'lease_owner': 'TEXT',
+            'lease_expires': 'REAL',
+            'variant': 'TEXT',
+            'variants': 'TEXT',
+            'original_url': 'TEXT'
+        })
+        if 'status' in added:
+            # Older runs set downloaded = TRUE for failures too; those rows
+            # never got a local_path, so they are queued up again.
+            cursor.execute('''
+                UPDATE media SET status = CASE WHEN local_path IS NOT NULL THEN 'done' ELSE 'failed' END,
+                                 attempts = 1
+                WHERE downloaded
+            ''')
+            cursor.execute('UPDATE media SET downloaded = FALSE WHERE downloaded AND local_path IS NULL')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_url ON media (media_url)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_post ON media (post_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_status ON media (status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_digest ON media (digest)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_lease ON media (lease_owner)')
+
+        # Resized copies of downloaded images, shared by every row with the
+        # same digest; path is relative to the media directory.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media_derivatives (
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                format TEXT NOT NULL,
+                path TEXT NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                bytes INTEGER,
+                source_mtime REAL,
+                created_at TEXT,
+                PRIMARY KEY (digest, size, format)
+            )
+        ''')
+
+        # Last verify of each stored file: it is only read again once its
+        # size or mtime change, or to hash a file only stat'ed before.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media_verified (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                hashed BOOLEAN,
+                verified_at TEXT
+            )
+        ''')
+
+        # Listing indexes: every filter combination the viewer offers can walk
+        # an index in (timestamp, id) order, which keyset pagination needs.
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_timestamp ON posts (timestamp, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_blog ON posts (blog_name, timestamp, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_type ON posts (type, timestamp, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_blog_type ON posts (blog_name, type, timestamp, id)')
+
+        # Full-text index for the viewer's search; rowid is the post id.
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5 (
+                title, body, tags, summary,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+        self.setup_stats(cursor)
+
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'post_render'")
+        had_render_fields = cursor.fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS post_render (
+                post_id INTEGER PRIMARY KEY,
+                title TEXT,
+                body TEXT,
+                quote TEXT,
+                source TEXT,
+                link_url TEXT,
+                description TEXT,
+                chat TEXT,
+                photos TEXT,
+                video_url TEXT,
+                audio_url TEXT,
+                FOREIGN KEY (post_id) REFERENCES posts (id)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS raw_data_dicts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data BLOB NOT NULL,
+                created_at TEXT
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS db_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        ''')
+        cursor.execute('''
+            INSERT OR IGNORE INTO db_meta (key, value)
+            VALUES ('generation', 0), ('updated_at', CAST(strftime('%s', 'now') AS INTEGER))
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                blog_name TEXT PRIMARY KEY,
+                newest_timestamp INTEGER,
+                newest_id INTEGER,
+                last_synced TEXT
+            )
+        ''')
+
+        # Where an unfinished walk down a blog got to: the `before` cursor for
+        # its next page and the newest post it started from.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS blog_checkpoints (
+                blog_name TEXT PRIMARY KEY,
+                before INTEGER,
+                newest_timestamp INTEGER,
+                newest_id INTEGER,
+                posts INTEGER,
+                updated_at TEXT
+            )
+        ''')
+
         conn.commit()
+        self.codec.load_current(conn)
+        # The viewer keeps searching with LIKE until db_meta says every
+        # post is indexed, so posts stored before the index never drop out.
+        if not cursor.execute("SELECT 1 FROM db_meta WHERE key = 'search_index_complete'").fetchone():
+            self.fill_search_index(conn)
+        if not had_render_fields:
+            self.fill_render_fields(conn)
+        # Idempotent, so a database that ran it before the flag existed
+        # only pays for one more pass.
+        if not cursor.execute("SELECT 1 FROM db_meta WHERE key = 'inline_media_complete'").fetchone():
+            self.fill_inline_media(conn)
         conn.close()
 
+    def setup_stats(self, cursor):
+        # Rollups behind the viewer's /stats page. Triggers keep them current
+        # inside whichever transaction touches posts or media, so ingest and
+        # download bookkeeping update them without any extra round trips.
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'post_stats'")
+        is_new = cursor.fetchone() is None
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS post_stats (
+                blog_name TEXT NOT NULL,
+                type TEXT NOT NULL,
+                month TEXT NOT NULL,
+                post_count INTEGER NOT NULL DEFAULT 0,
+                earliest_date TEXT,
+                latest_date TEXT,
+                PRIMARY KEY (blog_name, type, month)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media_stats (
+                media_type TEXT NOT NULL,
+                status TEXT NOT NULL,
+                item_count INTEGER NOT NULL DEFAULT 0,
+                total_bytes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (media_type, status)
+            )
+        ''')
+
+        cursor.executescript('''
+            CREATE TRIGGER IF NOT EXISTS posts_stats_insert AFTER INSERT ON posts BEGIN
+                INSERT INTO post_stats (blog_name, type, month, post_count, earliest_date, latest_date)
+                VALUES (COALESCE(NEW.blog_name, ''), COALESCE(NEW.type, ''),
+                        COALESCE(strftime('%Y-%m', NEW.timestamp, 'unixepoch'), ''), 1, NEW.date, NEW.date)
+                ON CONFLICT (blog_name, type, month) DO UPDATE SET
+                    post_count = post_count + 1,
+                    earliest_date = CASE WHEN earliest_date IS NULL OR excluded.earliest_date < earliest_date
+                                         THEN excluded.earliest_date ELSE earliest_date END,
+                    latest_date = CASE WHEN latest_date IS NULL OR excluded.latest_date > latest_date
+                                       THEN excluded.latest_date ELSE latest_date END;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS posts_stats_delete AFTER DELETE ON posts BEGIN
+                UPDATE post_stats SET post_count = post_count - 1
+                WHERE blog_name = COALESCE(OLD.blog_name, '') AND type = COALESCE(OLD.type, '')
+                  AND month = COALESCE(strftime('%Y-%m', OLD.timestamp, 'unixepoch'), '');
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS media_stats_insert AFTER INSERT ON media BEGIN
+                INSERT INTO media_stats (media_type, status, item_count, total_bytes)
+                VALUES (COALESCE(NEW.media_type, ''), NEW.status, 1, COALESCE(NEW.original_size, 0))
+                ON CONFLICT (media_type, status) DO UPDATE SET
+                    item_count = item_count + 1,
+                    total_bytes = total_bytes + excluded.total_bytes;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS media_stats_update AFTER UPDATE OF media_type, status, original_size ON media BEGIN
+                UPDATE media_stats SET
+                    item_count = item_count - 1,
+                    total_bytes = total_bytes - COALESCE(OLD.original_size, 0)
+                WHERE media_type = COALESCE(OLD.media_type, '') AND status = OLD.status;
+                INSERT INTO media_stats (media_type, status, item_count, total_bytes)
+                VALUES (COALESCE(NEW.media_type, ''), NEW.status, 1, COALESCE(NEW.original_size, 0))
+                ON CONFLICT (media_type, status) DO UPDATE SET
+                    item_count = item_count + 1,
+                    total_bytes = total_bytes + excluded.total_bytes;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS media_stats_delete AFTER DELETE ON media BEGIN
+                UPDATE media_stats SET
+                    item_count = item_count - 1,
+                    total_bytes = total_bytes - COALESCE(OLD.original_size, 0)
+                WHERE media_type = COALESCE(OLD.media_type, '') AND status = OLD.status;
+            END;
+        ''')
+
+        if is_new:
+            self.compute_stats(cursor)
+
+    def compute_stats(self, cursor):
+        cursor.execute('DELETE FROM post_stats')
+        cursor.execute('DELETE FROM media_stats')
+        cursor.execute('''
+            INSERT INTO post_stats (blog_name, type, month, post_count, earliest_date, latest_date)
+            SELECT COALESCE(blog_name, ''), COALESCE(type, ''),
+                   COALESCE(strftime('%Y-%m', timestamp, 'unixepoch'), ''),
+                   COUNT(*), MIN(date), MAX(date)
+            FROM posts
+            GROUP BY 1, 2, 3
+        ''')
+        cursor.execute('''
+            INSERT INTO media_stats (media_type, status, item_count, total_bytes)
+            SELECT COALESCE(media_type, ''), status, COUNT(*), COALESCE(SUM(original_size), 0)
+            FROM media
+            GROUP BY 1, 2
+        ''')
+
+    def rebuild_stats(self):
+        rollups = (('post_stats', 'post_count', 3), ('media_stats', 'item_count', 2))
+        with self.db_lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+
+            def snapshot(table, count, key_columns):
+                rows = cursor.execute(f'SELECT * FROM {table} WHERE {count} != 0').fetchall()
+                return {row[:key_columns]: row[key_columns:] for row in rows}
+
+            before = {table: snapshot(table, count, keys) for table, count, keys in rollups}
+            self.compute_stats(cursor)
+            bump_generation(cursor)
+            conn.commit()
+            for table, count, keys in rollups:
+                after = snapshot(table, count, keys)
+                differing = [key for key in before[table].keys() | after.keys()
+                             if before[table].get(key) != after.get(key)]
+                if differing:
+                    self.logger.warning(f"{table}: {len(differing)} of {len(after)} rows differed from the "
+                                        f"incremental rollup and were corrected")
+                else:
+                    self.logger.info(f"{table}: {len(after)} rows, matched the incremental rollup")
+
+    def add_missing_columns(self, cursor, table, columns):
+        # CREATE TABLE IF NOT EXISTS leaves older databases on the original
+        # schema, so newer columns are added in place.
+        cursor.execute(f'PRAGMA table_info({table})')
+        existing = {row[1] for row in cursor.fetchall()}
+        added = []
+        for name, definition in columns.items():
+            if name not in existing:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+                added.append(name)
+        return added
+
+    def get_high_water_mark(self, blog_name):
+        with self.db_lock:
+            return self.get_connection().execute(
+                'SELECT newest_timestamp, newest_id FROM sync_state WHERE blog_name = ?',
+                (blog_name,)
+            ).fetchone()
+
+    def save_high_water_mark(self, blog_name, newest):
+        with self.db_lock:
+            conn = self.get_connection()
+            conn.execute('''
+                INSERT INTO sync_state (blog_name, newest_timestamp, newest_id, last_synced)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (blog_name) DO UPDATE SET
+                    newest_timestamp = excluded.newest_timestamp,
+                    newest_id = excluded.newest_id,
+                    last_synced = excluded.last_synced
+            ''', (blog_name, newest[0], newest[1], datetime.now().isoformat()))
+            conn.commit()
+
+    def get_checkpoint(self, blog_name):
+        with self.db_lock:
+            return self.get_connection().execute(
+                'SELECT before, newest_timestamp, newest_id, posts FROM blog_checkpoints WHERE blog_name = ?',
+                (blog_name,)
+            ).fetchone()
+
+    def save_checkpoint(self, blog_name, before, newest, posts):
+        with self.db_lock:
+            conn = self.get_connection()
+            conn.execute('''
+                INSERT INTO blog_checkpoints (blog_name, before, newest_timestamp, newest_id, posts, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (blog_name) DO UPDATE SET
+                    before = excluded.before,
+                    newest_timestamp = excluded.newest_timestamp,
+                    newest_id = excluded.newest_id,
+                    posts = excluded.posts,
+                    updated_at = excluded.updated_at
+            ''', (blog_name, before, newest[0], newest[1], posts, datetime.now().isoformat()))
+            conn.commit()
+
+    def clear_checkpoint(self, blog_name):
+        with self.db_lock:
+            conn = self.get_connection()
+            conn.execute('DELETE FROM blog_checkpoints WHERE blog_name = ?', (blog_name,))
+            conn.commit()
+
     def load_tokens(self):
         token_file = '.tumblr_tokens'
         if os.path.exists(token_file):
@@ -128,12 +1541,7 @@ class TumblrBackup:
             raise ValueError("TUMBLR_CONSUMER_KEY and TUMBLR_CONSUMER_SECRET must be set in .env file")
 
         if self.load_tokens():
-            self.client = pytumblr.TumblrRestClient(
-                self.consumer_key,
-                self.consumer_secret,
-                self.access_token,
-                self.access_token_secret
-            )
+            self.client = self.create_client()
             try:
                 user_info = self.client.info()
                 if 'user' in user_info:
@@ -177,12 +1585,7 @@ class TumblrBackup:
 
         self.save_tokens(self.access_token, self.access_token_secret)
 
-        self.client = pytumblr.TumblrRestClient(
-            self.consumer_key,
-            self.consumer_secret,
-            self.access_token,
-            self.access_token_secret
-        )
+        self.client = self.create_client()
 
         try:
             user_info = self.client.info()
@@ -196,24 +1599,55 @@ class TumblrBackup:
             self.logger.error(f"Authentication failed: {e}")
             return False
 
+    def create_client(self):
+        client = pytumblr.TumblrRestClient(
+            self.consumer_key,
+            self.consumer_secret,
+            self.access_token,
+            self.access_token_secret
+        )
+        client.request = RetryingTumblrRequest(
+            self.consumer_key,
+            self.consumer_secret,
+            self.access_token,
+            self.access_token_secret,
+            self.api_host or client.request.host,
+            self.retrier,
+            self.rate_limiter,
+            self.create_session(self.blog_workers),
+            self.metrics
+        )
+        return client
+
     def get_user_blogs(self):
         user_info = self.client.info()
         return [blog['name'] for blog in user_info['user']['blogs']]
 
+    def resolution_policy(self, blog_name, media_type):
+        """The resolution policy for a blog's media of a type; a blog's own setting wins over its type's"""
+        overrides = self.resolution_overrides
+        return overrides.get(blog_name) or overrides.get(media_type) or self.resolution
+
     def extract_media_urls(self, post):
         media_urls = []
         post_type = post.get('type', '')
 
         if post_type == 'photo':
+            policy = self.resolution_policy(post.get('blog_name'), 'image')
             for photo in post.get('photos', []):
-                original_size = photo.get('original_size', {})
-                if original_size.get('url'):
-                    media_urls.append({
-                        'url': original_size['url'],
-                        'type': 'image',
-                        'width': original_size.get('width'),
-                        'height': original_size.get('height')
-                    })
+                variants = photo_variants(photo)
+                if not variants:
+                    continue
+                width, height, url = choose_variant(variants, policy)
+                media_urls.append({
+                    'url': url,
+                    'type': 'image',
+                    'width': width or None,
+                    'height': height or None,
+                    'variant': 'original' if url == variants[0][2] else f'{width}w',
+                    'variants': json.dumps(variants),
+                    'original_url': variants[0][2]
+                })
 
         elif post_type == 'video':
             video_url = post.get('video_url')
@@ -231,194 +1665,1234 @@ class TumblrBackup:
                     'type': 'audio'
                 })
 
+        seen = set()
+        for media in media_urls:
+            seen.update((media['url'], media.get('original_url')))
+        for field in INLINE_MEDIA_FIELDS:
+            for tag, _, url in INLINE_MEDIA.findall(post.get(field) or ''):
+                url = html.unescape(url)
+                if url not in seen:
+                    seen.add(url)
+                    media_urls.append({'url': url, 'type': 'image' if tag.lower() == 'img' else 'video'})
+
         return media_urls
 
-    def download_media(self, media_url, post_id, media_type):
+    def create_session(self, pool_size):
+        # Keep-alive connections shared by all download workers; one pool slot
+        # per worker so no thread ever waits on, or discards, a connection.
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def object_path(self, digest, ext):
+        return self.objects_dir / digest[:2] / f"{digest}{ext}"
+
+    def link_media(self, object_path, post_id, filename):
+        # Per-post paths are hardlinks into the object store; where the
+        # filesystem can't link, the row points at the object itself.
+        post_media_dir = self.media_dir / str(post_id)
+        post_media_dir.mkdir(exist_ok=True)
+        local_path = post_media_dir / filename
         try:
-            response = requests.get(media_url, stream=True, timeout=30)
-            response.raise_for_status()
-
-            parsed_url = urlparse(media_url)
-            filename = os.path.basename(parsed_url.path)
-            if not filename:
-                ext = mimetypes.guess_extension(response.headers.get('content-type', '')) or ''
-                filename = f"{hashlib.md5(media_url.encode()).hexdigest()}{ext}"
+            if local_path.exists():
+                if os.path.samefile(local_path, object_path):
+                    return str(local_path)
+                local_path.unlink()
+            os.link(object_path, local_path)
+            return str(local_path)
+        except OSError:
+            return str(object_path)
+
+    def derivative_path(self, digest, size, image_format):
+        return self.derivatives_dir / digest[:2] / f"{digest}_{size}{DERIVATIVE_FORMATS[image_format][1]}"
+
+    def live_lease_owners(self, conn):
+        return {owner for owner, in conn.execute(
+            'SELECT DISTINCT lease_owner FROM media WHERE lease_owner IS NOT NULL AND lease_expires >= ?',
+            (time.time(),))}
+
+    def part_is_stale(self, part, live_owners):
+        # Part files are named <md5(url)>-<lease_owner>.part; a run keeps its
+        # leases renewed while it downloads, so once they have all expired
+        # its part files are free to take over. Files from before owners
+        # were recorded only count once untouched for a lease period.
+        owner = part.stem[33:]
+        if owner:
+            return owner not in live_owners
+        return time.time() - part.stat().st_mtime >= MEDIA_LEASE_SECONDS
+
+    def adopt_part(self, tmp_dir, url_hash, part_path):
+        # Another run may be streaming into its own part file for the same
+        # URL (a reblog leased to it); one left by a run that is gone is
+        # taken over to resume.
+        others = list(tmp_dir.glob(f'{url_hash}*.part'))
+        if not others:
+            return
+        with closing(sqlite3.connect(self.db_path, timeout=30)) as conn:
+            live_owners = self.live_lease_owners(conn)
+        for other in others:
+            try:
+                if not self.part_is_stale(other, live_owners):
+                    continue
+                os.replace(other, part_path)
+                os.utime(part_path)
+                return
+            except FileNotFoundError:
+                continue
+
+    def fetch_part(self, media_url, part_path, state):
+        """Append the rest of media_url to part_path, returning its filename and expected size"""
+        headers = {'Range': f"bytes={state['size']}-"} if state['size'] else {}
+        response = self.retrier.request(self.session, 'GET', media_url, stream=True, timeout=30, headers=headers)
+        if response.status_code == 416:
+            response.close()
+            state.update(size=0, sha256=hashlib.sha256())
+            response = self.retrier.request(self.session, 'GET', media_url, stream=True, timeout=30)
+        response.raise_for_status()
+
+        expected_size = None
+        if response.status_code == 206:
+            content_range = response.headers.get('Content-Range', '')
+            start, _, total = content_range.removeprefix('bytes ').partition('/')
+            if not start.startswith(f"{state['size']}-"):
+                raise IOError(f"Unexpected Content-Range {content_range!r} for offset {state['size']}")
+            if total.isdigit():
+                expected_size = int(total)
+        else:
+            state.update(size=0, sha256=hashlib.sha256())
+            if 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers:
+                expected_size = int(response.headers['Content-Length'])
+
+        filename = os.path.basename(urlparse(media_url).path)
+        if not filename:
+            ext = mimetypes.guess_extension(response.headers.get('content-type', '')) or ''
+            filename = f"{hashlib.md5(media_url.encode()).hexdigest()}{ext}"
+
+        host = urlparse(media_url).netloc
+        start_size = state['size']
+        try:
+            with open(part_path, 'ab' if state['size'] else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    state['sha256'].update(chunk)
+                    state['size'] += len(chunk)
+                    if self.bandwidth:
+                        self.bandwidth.consume(host, len(chunk))
+        finally:
+            self.metrics.inc('tumblr_media_bytes_total', state['size'] - start_size, host=host)
 
-            post_media_dir = self.media_dir / str(post_id)
-            post_media_dir.mkdir(exist_ok=True)
+        return filename, expected_size
 
-            local_path = post_media_dir / filename
+    def probe_size(self, media_url):
+        """Content-Length of media_url from a HEAD request, or None"""
+        try:
+            response = self.session.head(media_url, timeout=10, allow_redirects=True)
+        except requests.RequestException:
+            return None
+        length = response.headers.get('Content-Length', '')
+        return int(length) if response.ok and length.isdigit() else None
 
-            with open(local_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+    def download_media(self, media_url, post_id, media_type):
+        if self.session is None:
+            self.session = self.create_session(self.media_workers)
+
+        # Bytes stream into a .part file named after the URL and this run,
+        # so an interrupted download resumes with a Range request. It only
+        # moves into the object store once complete.
+        tmp_dir = self.objects_dir / 'tmp'
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        url_hash = hashlib.md5(media_url.encode()).hexdigest()
+        part_path = tmp_dir / f"{url_hash}-{self.lease_owner}.part"
+        if not part_path.exists():
+            self.adopt_part(tmp_dir, url_hash, part_path)
 
-            return str(local_path)
+        try:
+            state = {'size': 0, 'sha256': hashlib.sha256()}
+            if part_path.exists():
+                with open(part_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                        state['sha256'].update(chunk)
+                        state['size'] += len(chunk)
+
+            for attempt in range(self.retrier.max_retries + 1):
+                try:
+                    filename, expected_size = self.fetch_part(media_url, part_path, state)
+                    break
+                except RETRY_EXCEPTIONS as e:
+                    if attempt == self.retrier.max_retries:
+                        raise
+                    self.logger.warning(f"Download of {media_url} interrupted at {state['size']} bytes ({e}), resuming")
+
+            size = state['size']
+            if expected_size is not None and size != expected_size:
+                if size > expected_size:
+                    part_path.unlink()
+                raise IOError(f"Expected {expected_size} bytes, got {size}")
+
+            digest = state['sha256'].hexdigest()
+            object_path = self.object_path(digest, Path(filename).suffix)
+            if object_path.exists():
+                part_path.unlink()
+            else:
+                object_path.parent.mkdir(exist_ok=True)
+                os.replace(part_path, object_path)
+
+            return {
+                'status': 'done',
+                'local_path': self.link_media(object_path, post_id, filename),
+                'object_path': object_path,
+                'filename': filename,
+                'digest': digest,
+                'size': size
+            }
 
         except Exception as e:
             self.logger.error(f"Failed to download {media_url}: {e}")
-            return None
+            return {
+                'status': 'partial' if part_path.exists() else 'failed',
+                'error': str(e)
+            }
+
+    def get_connection(self):
+        # One connection for the whole run; callers hold db_lock while using it.
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            # In WAL mode this only gives up the last commits on power loss,
+            # never consistency, and saves an fsync per transaction.
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+        return self.conn
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def lookup_tag_ids(self, cursor, tag_names):
+        missing = [name for name in tag_names if name not in self.tag_ids]
+        if missing:
+            cursor.executemany('INSERT OR IGNORE INTO tags (tag_name) VALUES (?)', [(name,) for name in missing])
+            for i in range(0, len(missing), SQL_BATCH_SIZE):
+                chunk = missing[i:i + SQL_BATCH_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'SELECT tag_name, id FROM tags WHERE tag_name IN ({placeholders})', chunk)
+                self.tag_ids.update(cursor.fetchall())
+        return self.tag_ids
 
     def save_post(self, post):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        return self.save_posts([post]) > 0
+
+    def save_posts(self, posts):
+        """Store a batch of posts in a single transaction, returning how many were new"""
+        with self.db_lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+
+            existing = set()
+            ids = [post['id'] for post in posts]
+            for i in range(0, len(ids), SQL_BATCH_SIZE):
+                chunk = ids[i:i + SQL_BATCH_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'SELECT id FROM posts WHERE id IN ({placeholders})', chunk)
+                existing.update(row[0] for row in cursor.fetchall())
+
+            new_posts = []
+            for post in posts:
+                if post['id'] not in existing:
+                    existing.add(post['id'])
+                    new_posts.append(post)
+
+            if not new_posts:
+                return 0
+
+            post_rows = []
+            search_rows = []
+            render_rows = []
+            tag_pairs = []
+            media_rows = []
+            for post in new_posts:
+                post_id = post['id']
+                search_rows.append((post_id,) + extract_search_text(post))
+                render_rows.append(render_row(post))
+                post_rows.append((
+                    post_id,
+                    post.get('blog_name'),
+                    post.get('type'),
+                    post.get('state'),
+                    post.get('format'),
+                    post.get('timestamp'),
+                    post.get('date'),
+                    ','.join(post.get('tags', [])),
+                    post.get('short_url'),
+                    post.get('summary'),
+                    post.get('reblog_key'),
+                    post.get('post_url'),
+                    post.get('slug'),
+                    post.get('note_count')
+                ))
+                for tag in post.get('tags', []):
+                    tag_pairs.append((post_id, tag))
+                for media in self.extract_media_urls(post):
+                    media_rows.append(media_row(post_id, media))
+
+            start = time.perf_counter()
+            try:
+                # Encode under the write lock with the newest dictionary, so
+                # compress-raw-data cannot drop it before these rows exist.
+                cursor.execute('BEGIN IMMEDIATE')
+                self.codec.load_current(conn)
+                post_rows = [row + (self.codec.encode(post),) for row, post in zip(post_rows, new_posts)]
+                cursor.executemany('''
+                    INSERT INTO posts (
+                        id, blog_name, type, state, format, timestamp, date, tags,
+                        short_url, summary, reblog_key, post_url, slug, note_count, raw_data
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', post_rows)
+                cursor.executemany(
+                    'INSERT INTO posts_fts (rowid, title, body, tags, summary) VALUES (?, ?, ?, ?, ?)',
+                    search_rows
+                )
+                cursor.executemany(RENDER_INSERT, render_rows)
+
+                tag_ids = self.lookup_tag_ids(cursor, list(dict.fromkeys(tag for _, tag in tag_pairs)))
+                cursor.executemany(
+                    'INSERT OR IGNORE INTO post_tags (post_id, tag_id) VALUES (?, ?)',
+                    [(post_id, tag_ids[tag]) for post_id, tag in tag_pairs]
+                )
+
+                cursor.executemany(MEDIA_INSERT, media_rows)
+
+                bump_generation(cursor)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                # Tags inserted by the rolled back transaction no longer exist.
+                self.tag_ids.clear()
+                raise
+
+            self.metrics.observe('tumblr_db_transaction_seconds', time.perf_counter() - start, operation='save_posts')
+            self.metrics.inc('tumblr_posts_stored_total', len(new_posts))
+            return len(new_posts)
+
+    def fill_search_index(self, conn, batch_size=1000):
+        """(Re)build posts_fts from the stored post JSON and mark it complete"""
+        read_cursor = conn.cursor()
+        write_cursor = conn.cursor()
+        write_cursor.execute('DELETE FROM posts_fts')
+        read_cursor.execute('SELECT id, raw_data FROM posts')
+        indexed = 0
+        while True:
+            rows = read_cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            write_cursor.executemany(
+                'INSERT INTO posts_fts (rowid, title, body, tags, summary) VALUES (?, ?, ?, ?, ?)',
+                [(post_id,) + extract_search_text(self.codec.decode(raw_data)) for post_id, raw_data in rows]
+            )
+            indexed += len(rows)
+        write_cursor.execute("INSERT INTO posts_fts (posts_fts) VALUES ('optimize')")
+        write_cursor.execute("INSERT OR REPLACE INTO db_meta (key, value) VALUES ('search_index_complete', 1)")
+        bump_generation(write_cursor)
+        conn.commit()
+        if indexed:
+            self.logger.info(f"Search index built for {indexed} posts")
+        return indexed
+
+    def rebuild_search_index(self):
+        with self.db_lock:
+            return self.fill_search_index(self.get_connection())
+
+    def fill_render_fields(self, conn, batch_size=1000):
+        """(Re)build post_render from the stored post JSON"""
+        read_cursor = conn.cursor()
+        write_cursor = conn.cursor()
+        write_cursor.execute('DELETE FROM post_render')
+        read_cursor.execute('SELECT raw_data FROM posts')
+        filled = 0
+        while True:
+            rows = read_cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            write_cursor.executemany(
+                RENDER_INSERT, [render_row(self.codec.decode(raw_data)) for raw_data, in rows]
+            )
+            filled += len(rows)
+        bump_generation(write_cursor)
+        conn.commit()
+        if filled:
+            self.logger.info(f"Render fields filled in for {filled} posts")
+        return filled
+
+    def fill_inline_media(self, conn, batch_size=1000):
+        """Queue media embedded in the HTML of posts stored before it was extracted"""
+        read_cursor = conn.cursor()
+        write_cursor = conn.cursor()
+        read_cursor.execute('SELECT id, raw_data FROM posts')
+        added = 0
+        while True:
+            rows = read_cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            media_rows = []
+            for post_id, raw_data in rows:
+                post = self.codec.decode(raw_data)
+                if not any(post.get(field) for field in INLINE_MEDIA_FIELDS):
+                    continue
+                known = set()
+                for url, original_url in write_cursor.execute(
+                        'SELECT media_url, original_url FROM media WHERE post_id = ?', (post_id,)):
+                    known.add(url)
+                    if original_url:
+                        known.add(original_url)
+                # Rows stored before original_url existed leave it NULL, and
+                # only photos carry one, so fall back to the URL itself.
+                media_rows.extend(
+                    media_row(post_id, media) for media in self.extract_media_urls(post)
+                    if media['url'] not in known and media.get('original_url', media['url']) not in known
+                )
+            write_cursor.executemany(MEDIA_INSERT, media_rows)
+            added += len(media_rows)
+        write_cursor.execute("INSERT OR REPLACE INTO db_meta (key, value) VALUES ('inline_media_complete', 1)")
+        bump_generation(write_cursor)
+        conn.commit()
+        if added:
+            self.logger.info(f"Queued {added} media files embedded in stored posts")
+        return added
+
+    def rebuild_render_fields(self):
+        with self.db_lock:
+            return self.fill_render_fields(self.get_connection())
+
+    def train_raw_data_dictionary(self, cursor):
+        cursor.execute('SELECT raw_data FROM posts ORDER BY RANDOM() LIMIT ?', (RAW_DICT_SAMPLE,))
+        samples = [json.dumps(self.codec.decode(row[0]), separators=(',', ':')) for row in cursor.fetchall()]
+        if not samples:
+            return None
+        dictionary = train_raw_data_dictionary(samples)
+        cursor.execute(
+            'INSERT INTO raw_data_dicts (data, created_at) VALUES (?, ?)',
+            (dictionary, datetime.now().isoformat())
+        )
+        return cursor.lastrowid
 
-        post_id = post['id']
+    def ensure_raw_data_dictionary(self):
+        # Posts stored before there was enough data to train on are only
+        # zlib-compressed; 'compress-raw-data' re-encodes them later.
+        if self.codec.current is not None:
+            return
+        with self.db_lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            if cursor.execute('SELECT COUNT(*) FROM posts').fetchone()[0] < RAW_DICT_SAMPLE:
+                return
+            self.train_raw_data_dictionary(cursor)
+            conn.commit()
+            self.codec.load_current(conn)
+        self.logger.info("Trained a compression dictionary for stored posts")
+
+    def raw_data_report(self, cursor, sample_ids):
+        page_count = cursor.execute('PRAGMA page_count').fetchone()[0]
+        page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+        raw_bytes = cursor.execute('SELECT TOTAL(LENGTH(raw_data)) FROM posts').fetchone()[0]
+        start = time.perf_counter()
+        for post_id in sample_ids:
+            row = cursor.execute('SELECT raw_data FROM posts WHERE id = ?', (post_id,)).fetchone()
+            self.codec.decode(row[0])
+        decode_ms = (time.perf_counter() - start) / max(len(sample_ids), 1) * 1000
+        return page_count * page_size, int(raw_bytes), decode_ms
+
+    def compress_raw_data(self, batch_size=1000):
+        with self.db_lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            sample_ids = [row[0] for row in cursor.execute(
+                'SELECT id FROM posts ORDER BY RANDOM() LIMIT 1000').fetchall()]
+            db_before, raw_before, decode_before = self.raw_data_report(cursor, sample_ids)
+
+            self.train_raw_data_dictionary(cursor)
+            conn.commit()
+            self.codec.load_current(conn)
+
+            converted = 0
+            last_id = None
+            while True:
+                cursor.execute(
+                    'SELECT id, raw_data FROM posts WHERE id > ? ORDER BY id LIMIT ?',
+                    (last_id if last_id is not None else -2 ** 63, batch_size)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                cursor.executemany(
+                    'UPDATE posts SET raw_data = ? WHERE id = ?',
+                    [(self.codec.encode(self.codec.decode(raw_data)), post_id) for post_id, raw_data in rows]
+                )
+                conn.commit()
+                converted += len(rows)
+                last_id = rows[-1][0]
+                self.logger.info(f"Compressed {converted} posts")
+
+            # A backup running alongside may still have written rows with an
+            # older dictionary; only those nothing points at are dropped.
+            cursor.execute('BEGIN IMMEDIATE')
+            keep = self.codec.referenced_dicts(conn) | {self.codec.current}
+            placeholders = ','.join('?' * len(keep))
+            cursor.execute(f'DELETE FROM raw_data_dicts WHERE id NOT IN ({placeholders})', list(keep))
+            bump_generation(cursor)
+            conn.commit()
+            cursor.execute('VACUUM')
+            db_after, raw_after, decode_after = self.raw_data_report(cursor, sample_ids)
+
+        mb = 1024 * 1024
+        self.logger.info(f"raw_data: {raw_before / mb:.1f} MB -> {raw_after / mb:.1f} MB "
+                         f"({raw_after / max(raw_before, 1):.0%}); database file: "
+                         f"{db_before / mb:.1f} MB -> {db_after / mb:.1f} MB")
+        self.logger.info(f"Single post raw_data fetch and decode: {decode_before:.3f} ms -> {decode_after:.3f} ms")
+        return converted
+
+    def pending_media(self, cursor, max_attempts, condition='', params=()):
+        # Each row comes with a stored copy of the same URL, if there is one,
+        # so reblogs are linked from the object store without a request.
+        # Left to itself the planner walks idx_media_status, i.e. every done
+        # row, for each pending one.
+        cursor.execute(f'''
+            SELECT m.id, m.post_id, m.media_url, m.media_type, m.width, m.height, known.digest, known.local_path
+            FROM media m
+            LEFT JOIN media known ON known.id = (
+                SELECT id FROM media INDEXED BY idx_media_url
+                WHERE media_url = m.media_url AND status = 'done' AND digest IS NOT NULL
+                LIMIT 1
+            )
+            WHERE m.status != 'done' AND m.attempts < ? {condition}
+        ''', (max_attempts, *params))
+        return cursor.fetchall()
 
-        cursor.execute('SELECT id FROM posts WHERE id = ?', (post_id,))
-        if cursor.fetchone():
+    def claim_media(self, conn, max_attempts, condition='', params=(), limit=SQL_BATCH_SIZE):
+        """Lease up to limit pending rows matching condition to this run, returning them and the last id"""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [row[0] for row in conn.execute(f'''
+                SELECT m.id FROM media m
+                WHERE m.status != 'done' AND m.attempts < ?
+                  AND (m.lease_expires IS NULL OR m.lease_expires < ?) {condition}
+                ORDER BY m.id LIMIT ?
+            ''', (max_attempts, time.time(), *params, limit))]
+            placeholders = ','.join('?' * len(ids))
+            conn.execute(f'UPDATE media SET lease_owner = ?, lease_expires = ? WHERE id IN ({placeholders})',
+                         (self.lease_owner, time.time() + MEDIA_LEASE_SECONDS, *ids))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if not ids:
+            return [], None
+        return self.pending_media(conn.cursor(), max_attempts, f'AND m.id IN ({placeholders})', ids), ids[-1]
+
+    def stream_media(self, pipeline, max_attempts, condition='', params=()):
+        """Claim matching rows chunk by chunk, in id order, and hand them to pipeline"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        last_id = 0
+        claimed = 0
+        try:
+            while True:
+                rows, last_id = self.claim_media(conn, max_attempts, f'AND m.id > ? {condition}',
+                                                 (last_id, *params))
+                if last_id is None:
+                    return claimed
+                claimed += len(rows)
+                pipeline.submit(rows)
+        finally:
             conn.close()
-            return False
 
-        cursor.execute('''
-            INSERT INTO posts (
-                id, blog_name, type, state, format, timestamp, date, tags,
-                short_url, summary, reblog_key, post_url, slug, note_count, raw_data
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            post_id,
-            post.get('blog_name'),
-            post.get('type'),
-            post.get('state'),
-            post.get('format'),
-            post.get('timestamp'),
-            post.get('date'),
-            ','.join(post.get('tags', [])),
-            post.get('short_url'),
-            post.get('summary'),
-            post.get('reblog_key'),
-            post.get('post_url'),
-            post.get('slug'),
-            post.get('note_count'),
-            json.dumps(post)
-        ))
-
-        for tag in post.get('tags', []):
-            cursor.execute('INSERT OR IGNORE INTO tags (tag_name) VALUES (?)', (tag,))
-            cursor.execute('SELECT id FROM tags WHERE tag_name = ?', (tag,))
-            tag_id = cursor.fetchone()[0]
-            cursor.execute('INSERT OR IGNORE INTO post_tags (post_id, tag_id) VALUES (?, ?)', (post_id, tag_id))
-
-        media_urls = self.extract_media_urls(post)
-        for media in media_urls:
-            cursor.execute('''
-                INSERT INTO media (post_id, media_url, media_type, width, height)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                post_id,
-                media['url'],
-                media['type'],
-                media.get('width'),
-                media.get('height')
-            ))
+    def download_all_media(self, max_workers=None, max_attempts=None):
+        # Rows are claimed a chunk at a time as the pipeline's queue drains,
+        # so memory stays flat however large the backlog is.
+        pipeline = MediaPipeline(self, max_workers or self.media_workers, self.media_queue_size).start()
+        try:
+            claimed = self.stream_media(pipeline, max_attempts or self.max_attempts)
+        finally:
+            completed, failed = pipeline.close()
 
-        conn.commit()
+        if not claimed:
+            self.logger.info("No media files to download")
+            return
+        self.logger.info(f"Media download complete: {completed - failed}/{completed} files"
+                         f"{f' ({failed} failed, retried on the next run)' if failed else ''}")
+
+    def upgrade_media(self, selectors=()):
+        """Queue the originals of media downloaded at a lower resolution, then download them
+
+        selectors narrow this down to blog names and/or media types.
+        """
+        types = [selector for selector in selectors if selector in MEDIA_TYPES]
+        blogs = [selector for selector in selectors if selector not in MEDIA_TYPES]
+        condition = "variant != 'original' AND original_url IS NOT NULL"
+        params = []
+        if types:
+            condition += f" AND media_type IN ({','.join('?' * len(types))})"
+            params += types
+        if blogs:
+            condition += f" AND post_id IN (SELECT id FROM posts WHERE blog_name IN ({','.join('?' * len(blogs))}))"
+            params += blogs
+
+        with self.db_lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                UPDATE media SET
+                    media_url = original_url,
+                    status = 'pending',
+                    attempts = 0,
+                    last_error = NULL
+                WHERE {condition}
+            ''', params)
+            upgraded = cursor.rowcount
+            bump_generation(cursor)
+            conn.commit()
+
+        self.logger.info(f"Queued {upgraded} media files for upgrade to their originals")
+        if upgraded:
+            self.download_all_media()
+        return upgraded
+
+    def resolution_report(self):
+        """Log what downloading below original resolution has saved, estimated from pixel counts"""
+        conn = sqlite3.connect(self.db_path)
+        files, downloaded, as_originals = conn.execute('''
+            SELECT COUNT(*), TOTAL(original_size),
+                   TOTAL(original_size * 1.0 * json_extract(variants, '$[0][0]') * json_extract(variants, '$[0][1]')
+                         / (width * height))
+            FROM media
+            WHERE status = 'done' AND variant != 'original' AND width > 0 AND height > 0
+        ''').fetchone()
         conn.close()
-        return True
+        if not files:
+            return None
+        mb = 1024 * 1024
+        saved = max(as_originals - downloaded, 0)
+        self.logger.info(f"Resolution policy: {files} files stored below original size, "
+                         f"{downloaded / mb:.1f} MB instead of about {as_originals / mb:.1f} MB "
+                         f"({saved / mb:.1f} MB, {saved / max(as_originals, 1):.0%} saved in bandwidth and disk)")
+        return files, downloaded, as_originals
+
+    def verify_media(self, hash_files=False, max_workers=None, batch_size=1000):
+        """Check every downloaded file against the media table, requeueing what is missing or corrupt"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        with conn:
+            # Legacy rows: failures marked downloaded, or "done" with no file.
+            conn.execute('UPDATE media SET downloaded = FALSE WHERE downloaded AND local_path IS NULL')
+            requeued = conn.execute('''
+                UPDATE media SET status = 'pending', attempts = 0, downloaded = FALSE,
+                                 last_error = 'verify: no local_path'
+                WHERE status = 'done' AND local_path IS NULL
+            ''').rowcount
+
+        checked = 0
+        relinked = 0
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=max_workers or self.verify_workers) as executor:
+            while True:
+                rows = conn.execute('''
+                    SELECT id, post_id, local_path, digest, original_size, media_type FROM media
+                    WHERE status = 'done' AND local_path IS NOT NULL AND id > ?
+                    ORDER BY id LIMIT ?
+                ''', (last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                # One check per stored file: rows sharing an object are
+                # hardlinks to it, and only need their link to exist.
+                jobs = {}
+                for media_id, post_id, local_path, digest, size, media_type in rows:
+                    path = str(self.object_path(digest, Path(local_path).suffix)) if digest else local_path
+                    job = jobs.setdefault(path, {'digest': digest, 'size': size, 'image': media_type == 'image',
+                                                 'rows': []})
+                    job['rows'].append((media_id, post_id, local_path))
+                placeholders = ','.join('?' * len(jobs))
+                previous = {path: (size, mtime, hashed) for path, size, mtime, hashed in conn.execute(
+                    f'SELECT path, size, mtime, hashed FROM media_verified WHERE path IN ({placeholders})',
+                    list(jobs))}
+
+                futures = {
+                    executor.submit(check_media_file, path, job['size'], job['image'], previous.get(path),
+                                    job['digest'] if hash_files else None,
+                                    [local_path for _, _, local_path in job['rows'] if local_path != path]): path
+                    for path, job in jobs.items()
+                }
+                verified = []
+                broken = []
+                relinks = []
+                for future in as_completed(futures):
+                    path = futures[future]
+                    job = jobs[path]
+                    problem, stat, missing_links = future.result()
+                    if problem:
+                        self.logger.warning(f"{path}: {problem}; queued for download again")
+                        broken.append((path, problem, job))
+                        continue
+                    verified.append((path, stat.st_size, stat.st_mtime,
+                                     hash_files or bool(previous.get(path, (0, 0, False))[2]),
+                                     datetime.now().isoformat()))
+                    for media_id, post_id, local_path in job['rows']:
+                        if local_path in missing_links:
+                            relinks.append((self.link_media(Path(path), post_id, Path(local_path).name), media_id))
+
+                with conn:
+                    conn.executemany('''
+                        INSERT OR REPLACE INTO media_verified (path, size, mtime, hashed, verified_at)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', verified)
+                    conn.executemany('UPDATE media SET local_path = ? WHERE id = ?', relinks)
+                    for path, problem, job in broken:
+                        # Nothing is deleted: the suspect file may be the
+                        # only copy left. Moving it out of the object store
+                        # lets a fresh download take its place.
+                        if os.path.exists(path):
+                            quarantined = self.quarantine_dir / f"{Path(path).parent.name}-{Path(path).name}"
+                            self.quarantine_dir.mkdir(exist_ok=True)
+                            os.replace(path, quarantined)
+                            self.logger.warning(f"{path}: moved to {quarantined}")
+                        conn.execute('DELETE FROM media_verified WHERE path = ?', (path,))
+                        conn.executemany('''
+                            UPDATE media SET status = 'pending', attempts = 0, downloaded = FALSE,
+                                             local_path = NULL, digest = NULL, original_size = NULL,
+                                             last_error = ?
+                            WHERE id = ?
+                        ''', [(f'verify: {problem}', media_id) for media_id, _, _ in job['rows']])
+                        requeued += len(job['rows'])
+                    if broken or relinks:
+                        bump_generation(conn)
+                checked += len(rows)
+                relinked += len(relinks)
+                self.logger.info(f"Verified {checked} media files")
+
+        orphans, orphan_bytes = self.find_orphans(conn)
+        conn.close()
+        self.logger.info(f"Verify complete: {checked} files checked, {requeued} requeued for download, "
+                         f"{relinked} links restored, {len(orphans)} orphaned files "
+                         f"({orphan_bytes / (1024 * 1024):.1f} MB) not referenced by the database")
+        for path in orphans[:20]:
+            self.logger.info(f"Orphaned: {path}")
+        return checked, requeued, orphans
+
+    def find_orphans(self, conn):
+        """Unreferenced files in the object store and per-post folders, and abandoned part files"""
+        orphans = []
+        total = 0
+        if not self.media_dir.is_dir():
+            return orphans, total
+        # Part files of runs that are gone; the next download of the same
+        # URL resumes from one, but until then it only takes up space.
+        tmp_dir = self.objects_dir / 'tmp'
+        if tmp_dir.is_dir():
+            live_owners = self.live_lease_owners(conn)
+            for part in tmp_dir.glob('*.part'):
+                try:
+                    if self.part_is_stale(part, live_owners):
+                        total += part.stat().st_size
+                        orphans.append(str(part))
+                except FileNotFoundError:
+                    continue
+        for prefix_dir in sorted(self.objects_dir.iterdir()) if self.objects_dir.is_dir() else ():
+            if prefix_dir.name == 'tmp' or not prefix_dir.is_dir():
+                continue
+            prefix = prefix_dir.name
+            referenced = {digest for digest, in conn.execute(
+                "SELECT digest FROM media WHERE digest >= ? AND digest < ? AND local_path IS NOT NULL",
+                (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))}
+            for entry in os.scandir(prefix_dir):
+                if Path(entry.name).stem not in referenced:
+                    orphans.append(entry.path)
+                    total += entry.stat().st_size
+        for post_dir in self.media_dir.iterdir():
+            if not post_dir.name.isdigit() or not post_dir.is_dir():
+                continue
+            referenced = {local_path for local_path, in conn.execute(
+                "SELECT local_path FROM media WHERE post_id = ? AND local_path IS NOT NULL", (int(post_dir.name),))}
+            for entry in os.scandir(post_dir):
+                if entry.path not in referenced and str(Path(entry.path)) not in referenced:
+                    orphans.append(entry.path)
+                    # A hardlink to a referenced object takes no extra space.
+                    if entry.stat().st_nlink == 1:
+                        total += entry.stat().st_size
+        return orphans, total
+
+    def backfill_digests(self, batch_size=500):
+        """Move files downloaded before the object store into it, filling in digest and original_size"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        filled = 0
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=self.verify_workers) as executor:
+            while True:
+                rows = conn.execute('''
+                    SELECT id, post_id, local_path FROM media
+                    WHERE status = 'done' AND digest IS NULL AND local_path IS NOT NULL AND id > ?
+                    ORDER BY id LIMIT ?
+                ''', (last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                paths = [local_path for _, _, local_path in rows]
+                digests = executor.map(lambda path: hash_file(path) if os.path.exists(path) else None, paths)
+
+                updates = []
+                for (media_id, post_id, local_path), digest in zip(rows, digests):
+                    # Missing files are left to verify to requeue.
+                    if digest is None:
+                        continue
+                    object_path = self.object_path(digest, Path(local_path).suffix)
+                    if not object_path.exists():
+                        object_path.parent.mkdir(parents=True, exist_ok=True)
+                        try:
+                            os.link(local_path, object_path)
+                        except OSError:
+                            shutil.copyfile(local_path, object_path)
+                    updates.append((digest, object_path.stat().st_size,
+                                    self.link_media(object_path, post_id, Path(local_path).name), media_id))
+                with conn:
+                    conn.executemany(
+                        'UPDATE media SET digest = ?, original_size = ?, local_path = ? WHERE id = ?', updates)
+                    if updates:
+                        bump_generation(conn)
+                filled += len(updates)
+                if updates:
+                    self.logger.info(f"Moved {filled} earlier downloads into the object store")
+        conn.close()
+        return filled
 
-    def download_all_media(self, max_workers=5):
+    def derivative_jobs(self, formats, size, batch_size=500):
+        """Yield (digest, format, source mtime, source, target) for every thumbnail that is missing or stale"""
         conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        last_digest = ''
+        try:
+            while True:
+                sources = conn.execute('''
+                    SELECT digest, MIN(local_path) FROM media
+                    WHERE status = 'done' AND media_type = 'image' AND digest > ?
+                    GROUP BY digest ORDER BY digest LIMIT ?
+                ''', (last_digest, batch_size)).fetchall()
+                if not sources:
+                    return
+                last_digest = sources[-1][0]
+                placeholders = ','.join('?' * len(sources))
+                existing = {
+                    (digest, image_format): source_mtime
+                    for digest, image_format, source_mtime in conn.execute(
+                        f'''SELECT digest, format, source_mtime FROM media_derivatives
+                            WHERE size = ? AND digest IN ({placeholders})''',
+                        [size] + [digest for digest, _ in sources])
+                }
+                # A derivative is current while its target exists and the
+                # object it was built from has not been rewritten since.
+                for digest, local_path in sources:
+                    source = self.object_path(digest, Path(local_path).suffix)
+                    try:
+                        mtime = source.stat().st_mtime
+                    except FileNotFoundError:
+                        continue
+                    for image_format in formats:
+                        target = self.derivative_path(digest, size, image_format)
+                        if existing.get((digest, image_format)) == mtime and target.exists():
+                            continue
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        yield digest, image_format, mtime, source, target
+        finally:
+            conn.close()
 
-        cursor.execute('SELECT id, post_id, media_url, media_type FROM media WHERE downloaded = FALSE')
-        media_items = cursor.fetchall()
+    def generate_derivatives(self, max_workers=None):
+        """Build thumbnails for every downloaded image that lacks a current one"""
+        if Image is None:
+            self.logger.warning("Pillow is not installed; skipping thumbnails")
+            return 0
+        formats = [f for f in self.derivative_formats if f == 'jpeg' or features.check(f)]
+        for skipped in set(self.derivative_formats) - set(formats):
+            self.logger.warning(f"This Pillow build cannot write {skipped}; skipping those derivatives")
+        size = self.thumbnail_size
+        workers = max_workers or self.thumbnail_workers or os.cpu_count() or 1
+        self.backfill_digests()
+
+        rows = []
+        built = 0
+        failed = 0
+        conn = sqlite3.connect(self.db_path, timeout=30)
+
+        def flush():
+            with conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO media_derivatives
+                        (digest, size, format, path, width, height, bytes, source_mtime, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+                bump_generation(conn)
+            rows.clear()
+
+        def finish(future, job):
+            nonlocal built, failed
+            digest, image_format, mtime, target = job
+            try:
+                width, height, length = future.result()
+            except Exception as e:
+                failed += 1
+                self.logger.error(f"Failed to build {image_format} thumbnail for {digest}: {e}")
+                return
+            built += 1
+            rows.append((digest, size, image_format, str(target.relative_to(self.media_dir)),
+                         width, height, length, mtime, datetime.now().isoformat()))
+            if len(rows) >= SQL_BATCH_SIZE:
+                flush()
+                self.logger.info(f"Built {built} thumbnails")
+
+        # Sources are read a batch at a time and only a couple of jobs per
+        # worker are in flight, so memory stays flat however large the archive.
+        in_flight = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for digest, image_format, mtime, source, target in self.derivative_jobs(formats, size):
+                if len(in_flight) >= workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(future, in_flight.pop(future))
+                future = executor.submit(build_derivative, str(source), str(target), size,
+                                         DERIVATIVE_FORMATS[image_format][0])
+                in_flight[future] = (digest, image_format, mtime, target)
+            for future in as_completed(in_flight):
+                finish(future, in_flight[future])
+        flush()
         conn.close()
 
-        if not media_items:
-            self.logger.info("No media files to download")
-            return
-
-        self.logger.info(f"Downloading {len(media_items)} media files...")
-
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_media = {
-                executor.submit(self.download_media, url, post_id, media_type): (media_id, url)
-                for media_id, post_id, url, media_type in media_items
-            }
-
-            completed = 0
-            for future in as_completed(future_to_media):
-                media_id, url = future_to_media[future]
-                local_path = future.result()
+        if not built and not failed:
+            self.logger.info("Thumbnails are up to date")
+        else:
+            self.logger.info(f"Thumbnails complete: {built}/{built + failed} built")
+        return built
 
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.cursor()
-
-                if local_path:
-                    cursor.execute(
-                        'UPDATE media SET local_path = ?, downloaded = TRUE WHERE id = ?',
-                        (local_path, media_id)
-                    )
-                else:
-                    cursor.execute(
-                        'UPDATE media SET downloaded = TRUE WHERE id = ?',
-                        (media_id,)
-                    )
-
-                conn.commit()
-                conn.close()
+    def backup_blog(self, blog_name, full=False):
+        self.logger.info(f"Starting backup for blog: {blog_name}")
 
-                completed += 1
-                if completed % 10 == 0:
-                    self.logger.info(f"Downloaded {completed}/{len(media_items)} files")
+        # Posts at or below the high-water mark were stored by an earlier run
+        # that paged all the way down, so a page made only of those means
+        # everything older is already in the database.
+        high_water = None if full else self.get_high_water_mark(blog_name)
+        high_water = tuple(high_water) if high_water else None
+        total_posts = 0
+        new_posts = 0
 
-        self.logger.info(f"Media download complete: {completed}/{len(media_items)} files")
+        # A walk that was cut short carries on from its last page. Once that
+        # reaches the bottom, only posts newer than where it began are left.
+        checkpoint = self.get_checkpoint(blog_name)
+        if checkpoint:
+            before, newest_timestamp, newest_id, walked = checkpoint
+            self.logger.info(f"[{blog_name}] Resuming an interrupted backup after {walked} posts")
+            high_water_after = (newest_timestamp, newest_id)
+            total_posts, new_posts = self.walk_blog(blog_name, high_water, high_water_after, before, walked)
+            high_water = high_water_after
+
+        total, new = self.walk_blog(blog_name, high_water, high_water)
+        total_posts += total
+        new_posts += new
+
+        self.logger.info(f"[{blog_name}] Blog backup complete: {total_posts} total posts, {new_posts} new posts")
+        return total_posts, new_posts
 
-    def backup_blog(self, blog_name):
-        self.logger.info(f"Starting backup for blog: {blog_name}")
+    def walk_blog(self, blog_name, high_water, newest, before=None, walked=0):
+        """Page down from the `before` timestamp (the newest post if None), checkpointing every page
 
-        offset = 0
+        Unlike offsets, a timestamp cursor costs the API the same at any
+        depth, and it stays put when new posts are published mid-walk.
+        """
         limit = 20
         total_posts = 0
         new_posts = 0
 
         while True:
-            posts = self.client.posts(blog_name, limit=limit, offset=offset)
+            params = {'limit': limit}
+            if before is not None:
+                params['before'] = before
+            posts = self.client.posts(blog_name, **params)
+
+            # Errors come back as the API envelope; bail out before the
+            # high-water mark is moved past posts that were never fetched.
+            if 'meta' in posts:
+                raise TumblrAPIError(f"{posts['meta'].get('status')} {posts['meta'].get('msg')} "
+                                     f"while fetching {blog_name} before {before}")
 
             if 'posts' not in posts or not posts['posts']:
                 break
+            page = posts['posts']
+
+            page_known = True
+            for post in page:
+                key = (post.get('timestamp') or 0, post['id'])
+                if not high_water or key > high_water:
+                    page_known = False
+                if not newest or key > newest:
+                    newest = key
+
+            self.metrics.inc('tumblr_posts_fetched_total', len(page))
+            saved = self.save_posts(page)
+            if saved and self.media_pipeline:
+                self.queue_page_media([post['id'] for post in page])
+            new_posts += saved
+            total_posts += len(page)
+
+            self.logger.info(f"[{blog_name}] Processed {walked + total_posts} posts ({new_posts} new)")
+
+            if page_known:
+                self.logger.info(f"[{blog_name}] Reached posts from the previous sync, stopping")
+                break
 
-            for post in posts['posts']:
-                if self.save_post(post):
-                    new_posts += 1
-                total_posts += 1
-
-            self.logger.info(f"Processed {total_posts} posts ({new_posts} new)")
-
-            if len(posts['posts']) < limit:
+            if len(page) < limit:
                 break
 
-            offset += limit
-            time.sleep(0.5)
+            # Posts sharing the oldest timestamp may straddle two pages, so
+            # the next page starts from that second again (repeats are not
+            # saved twice). Only a full page from a single second moves on.
+            oldest = min(post.get('timestamp') or 0 for post in page)
+            before = oldest + 1 if before is None or oldest + 1 < before else oldest
+            self.save_checkpoint(blog_name, before, newest, walked + total_posts)
 
-        self.logger.info(f"Blog backup complete: {total_posts} total posts, {new_posts} new posts")
+        if newest:
+            self.save_high_water_mark(blog_name, newest)
+        self.clear_checkpoint(blog_name)
         return total_posts, new_posts
 
-    def run_backup(self):
+    def queue_page_media(self, post_ids):
+        placeholders = ','.join('?' * len(post_ids))
+        with self.db_lock:
+            rows, _ = self.claim_media(self.get_connection(), self.max_attempts,
+                                       f'AND m.post_id IN ({placeholders}) AND m.id > ?',
+                                       (*post_ids, self.media_pipeline.first_id), limit=-1)
+        self.media_pipeline.submit(rows)
+
+    def start_metrics_server(self):
+        handler = type('BackupMetricsHandler', (MetricsHandler,), {'metrics': self.metrics})
+        server = ThreadingHTTPServer(('127.0.0.1', self.metrics_port), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        self.logger.info(f"Serving metrics on http://127.0.0.1:{server.server_port}/metrics")
+        return server
+
+    def write_metrics_summary(self):
+        with open(self.metrics_path, 'w') as f:
+            json.dump(self.metrics.summary(), f, indent=2, sort_keys=True)
+        self.logger.info(f"Metrics summary written to {self.metrics_path}")
+
+    def run_backup(self, full=False):
+        metrics_server = self.start_metrics_server() if self.metrics_port is not None else None
+        try:
+            return self.backup_all(full)
+        finally:
+            self.write_metrics_summary()
+            if metrics_server:
+                metrics_server.shutdown()
+                metrics_server.server_close()
+
+    def backup_blogs(self, blogs, full=False):
+        """Page through every blog; with pipeline set, download their media meanwhile"""
+        if self.pipeline:
+            # Media rows from earlier runs are left for after pagination, so
+            # the pipeline only takes rows added past this point by page.
+            with self.db_lock:
+                first_id = self.get_connection().execute('SELECT COALESCE(MAX(id), 0) FROM media').fetchone()[0]
+            self.media_pipeline = MediaPipeline(self, self.media_workers, self.media_queue_size, first_id).start()
+
+        total_posts = 0
+        total_new = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.blog_workers) as executor:
+                future_to_blog = {executor.submit(self.backup_blog, blog, full): blog for blog in blogs}
+                for future in as_completed(future_to_blog):
+                    blog = future_to_blog[future]
+                    try:
+                        posts, new = future.result()
+                    except Exception as e:
+                        self.logger.error(f"Backup failed for blog {blog}: {e}")
+                        continue
+                    total_posts += posts
+                    total_new += new
+
+            self.logger.info(f"All blogs backed up: {total_posts} total posts, {total_new} new posts")
+            if self.media_pipeline:
+                self.stream_media(self.media_pipeline, self.max_attempts,
+                                  'AND m.id <= ?', (self.media_pipeline.first_id,))
+        finally:
+            if self.media_pipeline:
+                completed, failed = self.media_pipeline.close()
+                self.media_pipeline = None
+                self.logger.info(f"Media download complete: {completed - failed}/{completed} files"
+                                 f"{f' ({failed} failed, retried on the next run)' if failed else ''}")
+        return total_posts, total_new
+
+    def backup_all(self, full):
         if not self.authenticate():
             return False
 
         blogs = self.get_user_blogs()
         self.logger.info(f"Found {len(blogs)} blogs: {', '.join(blogs)}")
 
-        total_posts = 0
-        total_new = 0
-
-        for blog in blogs:
-            posts, new = self.backup_blog(blog)
-            total_posts += posts
-            total_new += new
-
-        self.logger.info(f"All blogs backed up: {total_posts} total posts, {total_new} new posts")
+        self.backup_blogs(blogs, full)
+        self.ensure_raw_data_dictionary()
 
-        self.download_all_media()
+        if not self.pipeline:
+            self.download_all_media()
+        self.resolution_report()
+        self.generate_derivatives()
+        self.close()
 
         self.logger.info("Backup complete!")
         return True
 
+def derivative_formats(value):
+    formats = [f.strip().lower() for f in value.split(',') if f.strip()]
+    unknown = [f for f in formats if f not in DERIVATIVE_FORMATS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unsupported format(s): {', '.join(unknown)}")
+    return formats
+
+def byte_rate(value):
+    """Bytes per second, with an optional K, M or G suffix"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().removesuffix('/S').removesuffix('B')
+    try:
+        if value[-1:] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid rate: {value!r}")
+
+def resolution(value):
+    """original, max:<width> or alt:<width>"""
+    kind, _, width = value.strip().lower().partition(':')
+    if kind == 'original' and not width:
+        return ('original', None)
+    if kind in ('max', 'alt') and width.isdigit():
+        return (kind, int(width))
+    raise argparse.ArgumentTypeError(f"invalid resolution {value!r}: use original, max:<width> or alt:<width>")
+
+def resolution_override(value):
+    key, sep, policy = value.partition('=')
+    if not sep or not key.strip():
+        raise argparse.ArgumentTypeError(f"invalid override {value!r}: use <blog or media type>=<resolution>")
+    return key.strip(), resolution(policy)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Back up Tumblr posts and media to SQLite.')
+    parser.add_argument('command', nargs='?', default='backup',
+                        choices=['backup', 'rebuild-search-index', 'rebuild-stats', 'compress-raw-data',
+                                 'rebuild-render-fields', 'thumbnails', 'upgrade-media', 'verify'],
+                        help='backup (default) fetches new posts and media; rebuild-search-index '
+                             'refills the full-text index from the stored posts; rebuild-stats '
+                             'recomputes the statistics rollup and reports any drift; compress-raw-data '
+                             're-encodes stored post JSON with a freshly trained dictionary; '
+                             'rebuild-render-fields re-extracts the display fields the viewer lists; '
+                             'thumbnails builds any missing thumbnails for downloaded images; '
+                             'upgrade-media downloads originals for media stored at a lower resolution; '
+                             'verify checks downloaded files and requeues missing or corrupt ones')
+    parser.add_argument('--blog-workers', type=int, default=4,
+                        help='number of blogs to page through concurrently (default: 4)')
+    parser.add_argument('--requests-per-hour', type=int, default=DEFAULT_REQUESTS_PER_HOUR,
+                        help='API calls allowed per hour across all workers, 0 for no limit')
+    parser.add_argument('--requests-per-day', type=int, default=DEFAULT_REQUESTS_PER_DAY,
+                        help='API calls allowed per day across all workers, 0 for no limit')
+    parser.add_argument('--media-workers', type=int, default=DEFAULT_MEDIA_WORKERS,
+                        help=f'concurrent media downloads, also the HTTP connection pool size (default: {DEFAULT_MEDIA_WORKERS})')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f'bytes read per chunk when streaming media to disk (default: {DEFAULT_CHUNK_SIZE})')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help=f'give up on a media file after this many failed runs (default: {DEFAULT_MAX_ATTEMPTS})')
+    parser.add_argument('--thumbnail-size', type=int, default=DEFAULT_THUMBNAIL_SIZE,
+                        help=f'longest side in pixels of the listing thumbnails (default: {DEFAULT_THUMBNAIL_SIZE})')
+    parser.add_argument('--derivative-formats', type=derivative_formats, default=[],
+                        help='comma-separated extra thumbnail formats to build next to JPEG: webp, avif')
+    parser.add_argument('--thumbnail-workers', type=int, default=None,
+                        help='processes used to build thumbnails (default: one per CPU)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics on this local port while the backup runs')
+    parser.add_argument('--metrics-file', default='backup_metrics.json',
+                        help='where to write the JSON metrics summary at the end of a backup '
+                             '(default: backup_metrics.json)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='download media while blogs are still being paged instead of after '
+                             'all of them are done')
+    parser.add_argument('--media-queue-size', type=int, default=DEFAULT_MEDIA_QUEUE_SIZE,
+                        help=f'media URLs waiting for a download worker before fetching posts '
+                             f'pauses (default: {DEFAULT_MEDIA_QUEUE_SIZE})')
+    parser.add_argument('--host-workers', type=int, default=None,
+                        help='most concurrent downloads from any one media host (default: no limit '
+                             'beyond --media-workers)')
+    parser.add_argument('--download-order', choices=DOWNLOAD_ORDERS, default='fifo',
+                        help='start queued downloads in the order found (fifo, the default), or '
+                             'smallest or largest expected size first')
+    parser.add_argument('--probe-sizes', action='store_true',
+                        help='with a size-based --download-order, ask each media host for the file '
+                             'size (HEAD) instead of estimating it from the media type')
+    parser.add_argument('--max-bandwidth', type=byte_rate, default=None,
+                        help='cap on total download speed in bytes per second, e.g. 5M')
+    parser.add_argument('--host-bandwidth', type=byte_rate, default=None,
+                        help='cap on download speed from each media host, e.g. 1M')
+    parser.add_argument('--resolution', type=resolution, default=('original', None),
+                        help='photo size to download: original (default), max:<width> for the largest '
+                             'size at most that wide, or alt:<width> for that exact size')
+    parser.add_argument('--resolution-for', type=resolution_override, action='append', default=[],
+                        metavar='BLOG_OR_TYPE=RESOLUTION',
+                        help='resolution for one blog or media type, e.g. myblog=original; may be repeated')
+    parser.add_argument('--upgrade-only', action='append', default=[], metavar='BLOG_OR_TYPE',
+                        help='with upgrade-media, only upgrade this blog or media type; may be repeated')
+    parser.add_argument('--verify-hash', action='store_true',
+                        help='with verify, also compare each file with its SHA-256 (reads every byte)')
+    parser.add_argument('--verify-workers', type=int, default=None,
+                        help='threads checking files during verify (default: 4 per CPU, at most 32)')
+    parser.add_argument('--full', action='store_true',
+                        help='rescan every blog from the newest post to the oldest instead of '
+                             'stopping at posts stored by the previous run')
+    return parser.parse_args(argv)
+
 def main():
-    backup = TumblrBackup()
-    backup.run_backup()
+    args = parse_args()
+    backup = TumblrBackup(
+        blog_workers=args.blog_workers,
+        requests_per_hour=args.requests_per_hour,
+        requests_per_day=args.requests_per_day,
+        media_workers=args.media_workers,
+        chunk_size=args.chunk_size,
+        max_attempts=args.max_attempts,
+        thumbnail_size=args.thumbnail_size,
+        derivative_formats=args.derivative_formats,
+        thumbnail_workers=args.thumbnail_workers,
+        metrics_port=args.metrics_port,
+        metrics_path=args.metrics_file,
+        pipeline=args.pipeline,
+        media_queue_size=args.media_queue_size,
+        host_workers=args.host_workers,
+        download_order=args.download_order,
+        probe_sizes=args.probe_sizes,
+        max_bandwidth=args.max_bandwidth,
+        host_bandwidth=args.host_bandwidth,
+        resolution=args.resolution,
+        resolution_overrides=args.resolution_for,
+        verify_workers=args.verify_workers
+    )
+    if args.command == 'rebuild-search-index':
+        backup.rebuild_search_index()
+    elif args.command == 'rebuild-stats':
+        backup.rebuild_stats()
+    elif args.command == 'compress-raw-data':
+        backup.compress_raw_data()
+    elif args.command == 'rebuild-render-fields':
+        backup.rebuild_render_fields()
+    elif args.command == 'thumbnails':
+        backup.generate_derivatives()
+    elif args.command == 'upgrade-media':
+        backup.upgrade_media(args.upgrade_only)
+    elif args.command == 'verify':
+        backup.verify_media(hash_files=args.verify_hash)
+    else:
+        backup.run_backup(full=args.full)
+    backup.close()
 
 if __name__ == '__main__':
     main()
@@ -2,74 +2,396 @@
 
 import sqlite3
 import json
+import re
+import time
+import hashlib
+import html
+import functools
+import threading
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, send_from_directory, url_for
-from urllib.parse import urlparse
+from flask import Flask, Response, g, render_template, request, jsonify, send_from_directory, url_for, make_response
+from markupsafe import Markup, escape
+from tumblr_backup import (RawDataCodec, Metrics, RENDER_COLUMNS, DEFAULT_THUMBNAIL_SIZE, SQL_BATCH_SIZE,
+                           extract_render_fields)
 import os
 
 app = Flask(__name__)
 app.config['DATABASE'] = 'tumblr_backup.db'
 app.config['MEDIA_FOLDER'] = 'media'
-
-def get_db_connection():
-    conn = sqlite3.connect(app.config['DATABASE'])
+# Rendered pages are cached per database generation; set the directory to
+# also keep them on disk across viewer restarts.
+app.config['RESPONSE_CACHE_BYTES'] = 64 * 1024 * 1024
+app.config['RESPONSE_CACHE_DIR'] = None
+# Must match the backup's --thumbnail-size for listings to find thumbnails.
+app.config['THUMBNAIL_SIZE'] = DEFAULT_THUMBNAIL_SIZE
+
+# Columns the listing renders. Display fields come from post_render, so the
+# listing never decodes raw_data; only the detail page does.
+LISTING_COLUMNS = """posts.id, posts.blog_name, posts.type, posts.timestamp, posts.date,
+                     posts.tags, posts.summary, posts.note_count, """ + \
+                  ', '.join(f'post_render.{column}' for column in RENDER_COLUMNS)
+LISTING_JOIN = "LEFT JOIN post_render ON post_render.post_id = posts.id"
+
+metrics = Metrics({
+    'viewer_request_seconds': ('histogram', 'Time to answer a request, by endpoint and status'),
+    'viewer_response_cache_total': ('counter', 'Cached views served from memory or disk (hit), rendered (miss) or answered 304'),
+    'viewer_db_connections': ('gauge', 'Idle pooled read-only connections, by database'),
+})
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    if 'request_start' in g:
+        metrics.observe('viewer_request_seconds', time.perf_counter() - g.request_start,
+                        endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+raw_data_codecs = {}
+
+def decode_raw_data(value):
+    codec = raw_data_codecs.get(app.config['DATABASE'])
+    if codec is None:
+        codec = raw_data_codecs[app.config['DATABASE']] = RawDataCodec(app.config['DATABASE'])
+    return codec.decode(value)
+
+# Read-only connections are kept open and handed to one request at a time,
+# so their page cache and memory map outlive the request. With the database
+# in WAL mode they read a consistent snapshot while a backup writes, instead
+# of waiting on its locks.
+db_pools = {}
+db_pools_lock = threading.Lock()
+
+def open_db_connection(database):
+    path = Path(database).resolve().as_posix()
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA mmap_size = 268435456')
+    conn.execute('PRAGMA cache_size = -65536')
+    conn.execute('PRAGMA temp_store = MEMORY')
     return conn
 
-def format_post_content(post):
-    """Format post content based on type"""
-    raw_data = json.loads(post['raw_data']) if post['raw_data'] else {}
-
-    content = {
-        'title': '',
-        'body': '',
-        'summary': post['summary'] or '',
-        'photos': [],
-        'video_url': '',
-        'audio_url': '',
-        'text': '',
-        'quote': '',
-        'source': '',
-        'chat': [],
-        'link_url': '',
-        'description': ''
-    }
-
-    post_type = post['type']
-
-    if post_type == 'text':
-        content['title'] = raw_data.get('title', '')
-        content['body'] = raw_data.get('body', '')
-
-    elif post_type == 'photo':
-        content['photos'] = raw_data.get('photos', [])
-        content['body'] = raw_data.get('caption', '')
-
-    elif post_type == 'quote':
-        content['quote'] = raw_data.get('text', '')
-        content['source'] = raw_data.get('source', '')
-
-    elif post_type == 'link':
-        content['title'] = raw_data.get('title', '')
-        content['link_url'] = raw_data.get('url', '')
-        content['description'] = raw_data.get('description', '')
+def get_db_connection():
+    """The request's read-only connection, taken from the pool on first use"""
+    if 'db' not in g:
+        database = app.config['DATABASE']
+        with db_pools_lock:
+            pool = db_pools.setdefault(database, [])
+            conn = pool.pop() if pool else None
+        g.db = (database, conn or open_db_connection(database))
+    return g.db[1]
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    entry = g.pop('db', None)
+    if entry is not None:
+        database, conn = entry
+        with db_pools_lock:
+            db_pools[database].append(conn)
+            metrics.set('viewer_db_connections', len(db_pools[database]), database=database)
+
+# snippet() wraps matches in these so the text can be escaped before the
+# <mark> tags go in.
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+# Totals and filter choices only feed the page header, so they are reused
+# for a little while instead of being recounted on every request.
+COUNT_CACHE_SECONDS = 60
+count_cache = {}
+count_cache_lock = threading.Lock()
+
+def cached_query(key, compute):
+    # Within one database generation the answer cannot change.
+    key = (g.get('db_generation'), key)
+    now = time.monotonic()
+    with count_cache_lock:
+        entry = count_cache.get(key)
+        if entry and now - entry[0] < COUNT_CACHE_SECONDS:
+            return entry[1]
+    value = compute()
+    with count_cache_lock:
+        # Entries from other generations can never be hit again.
+        for stale in [k for k in count_cache if k[0] != key[0]]:
+            del count_cache[stale]
+        count_cache[key] = (now, value)
+    return value
+
+class ResponseCache:
+    """LRU of rendered response bodies, bounded by their total size
+
+    Entries are only valid for the database generation they were rendered
+    from, so everything is dropped as soon as a request sees another one.
+    """
 
-    elif post_type == 'chat':
-        content['title'] = raw_data.get('title', '')
-        content['chat'] = raw_data.get('dialogue', [])
+    def __init__(self, max_bytes, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = Path(directory) if directory else None
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = None
+        self.lock = threading.Lock()
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def set_generation(self, generation):
+        # Caller holds the lock.
+        if generation == self.generation:
+            return
+        self.generation = generation
+        self.entries.clear()
+        self.size = 0
+        if self.directory:
+            for path in self.directory.iterdir():
+                if not path.name.startswith(f'{generation}-'):
+                    path.unlink(missing_ok=True)
+
+    def get(self, generation, key):
+        with self.lock:
+            self.set_generation(generation)
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.directory:
+            try:
+                mimetype, body = (self.directory / f'{generation}-{key}').read_bytes().split(b'\n', 1)
+            except (FileNotFoundError, ValueError):
+                return None
+            entry = (body, mimetype.decode())
+            self.put(generation, key, entry, write=False)
+            return entry
+        return None
+
+    def put(self, generation, key, entry, write=True):
+        body, mimetype = entry
+        with self.lock:
+            self.set_generation(generation)
+            if len(body) > self.max_bytes:
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[0])
+            self.entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        if write and self.directory:
+            path = self.directory / f'{generation}-{key}'
+            # Names contain dots, so with_suffix would give every key one temp file.
+            temp_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+            temp_path.write_bytes(mimetype.encode() + b'\n' + body)
+            os.replace(temp_path, path)
+
+response_caches = {}
+
+def get_response_cache():
+    config = (app.config['DATABASE'], app.config['RESPONSE_CACHE_BYTES'], app.config['RESPONSE_CACHE_DIR'])
+    cache = response_caches.get(config)
+    if cache is None:
+        cache = response_caches[config] = ResponseCache(*config[1:])
+    return cache
+
+def get_db_version():
+    """Return the generation from db_meta, or None for databases without it"""
+    try:
+        rows = dict(get_db_connection().execute(
+            "SELECT key, value FROM db_meta WHERE key IN ('generation', 'updated_at')"))
+    except sqlite3.OperationalError:
+        return None
+    if 'generation' not in rows:
+        return None
+    updated_at = rows.get('updated_at') or 0
+    # updated_at tells a recreated database apart from the one it replaced.
+    return f"{rows['generation']}.{updated_at}"
+
+def cached_response(view):
+    """Serve a view from the response cache, with ETag revalidation"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        generation = get_db_version()
+        if generation is None:
+            return view(*args, **kwargs)
+        g.db_generation = generation
+        key = hashlib.sha256(repr((request.path, sorted(request.args.items(multi=True)))).encode()).hexdigest()
+
+        def conditional(response):
+            # No Last-Modified: its one-second resolution would let a client
+            # revalidate a page from before a write in the same second.
+            response.set_etag(f'{generation}-{key[:16]}')
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+
+        # A client holding the current version never gets the page rendered.
+        not_modified = conditional(Response())
+        if not_modified.status_code == 304:
+            metrics.inc('viewer_response_cache_total', result='not_modified')
+            return not_modified
+
+        cache = get_response_cache()
+        entry = cache.get(generation, key)
+        metrics.inc('viewer_response_cache_total', result='miss' if entry is None else 'hit')
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            entry = (response.get_data(), response.mimetype)
+            cache.put(generation, key, entry)
+        return conditional(Response(entry[0], mimetype=entry[1]))
+    return wrapper
+
+def parse_cursor(value):
+    """Parse a '<timestamp>:<id>' listing cursor"""
+    try:
+        timestamp, post_id = value.split(':')
+        return int(timestamp), int(post_id)
+    except (AttributeError, ValueError):
+        return None
+
+def make_cursor(post):
+    return f"{post['timestamp']}:{post['id']}"
+
+def has_search_index(conn):
+    # Set once every stored post is indexed; until then search uses LIKE.
+    try:
+        return conn.execute("SELECT 1 FROM db_meta WHERE key = 'search_index_complete'").fetchone() is not None
+    except sqlite3.OperationalError:
+        return False
+
+def has_render_fields(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'post_render'").fetchone() is not None
+
+def lookup_thumbnails(conn, post_ids):
+    """Map media URL to {format: path} for the listed posts' downloaded images"""
+    thumbnails = {}
+    try:
+        for i in range(0, len(post_ids), SQL_BATCH_SIZE):
+            chunk = post_ids[i:i + SQL_BATCH_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(f"""
+                SELECT media.media_url, media.original_url, media_derivatives.format, media_derivatives.path
+                FROM media
+                JOIN media_derivatives ON media_derivatives.digest = media.digest
+                WHERE media.post_id IN ({placeholders}) AND media.local_path IS NOT NULL
+                  AND media_derivatives.size = ?
+            """, chunk + [app.config['THUMBNAIL_SIZE']]).fetchall()
+            for media_url, original_url, image_format, path in rows:
+                thumbnails.setdefault(media_url, {})[image_format] = path
+                if original_url:
+                    thumbnails.setdefault(original_url, {})[image_format] = path
+    except sqlite3.OperationalError:
+        pass
+    return thumbnails
+
+@app.template_filter()
+def media_relpath(local_path):
+    """Path of a stored media file relative to the media folder, or None if outside it"""
+    if not local_path:
+        return None
+    relpath = os.path.relpath(os.path.abspath(local_path), os.path.abspath(app.config['MEDIA_FOLDER']))
+    if relpath.startswith('..'):
+        return None
+    return Path(relpath).as_posix()
+
+def local_media_href(local_path):
+    relpath = media_relpath(local_path)
+    return url_for('serve_media', filename=relpath) if relpath else None
+
+def lookup_local_media(conn, post_ids):
+    """Map remote media URL to its local /media/ URL for the given posts, in one query per batch
+
+    Posts link the original of each photo, so a downloaded smaller size is
+    found by its original_url as well.
+    """
+    local_media = {}
+    for i in range(0, len(post_ids), SQL_BATCH_SIZE):
+        chunk = post_ids[i:i + SQL_BATCH_SIZE]
+        placeholders = ','.join('?' * len(chunk))
+        rows = conn.execute(f"""
+            SELECT media_url, original_url, local_path FROM media
+            WHERE post_id IN ({placeholders}) AND local_path IS NOT NULL
+        """, chunk).fetchall()
+        for media_url, original_url, local_path in rows:
+            href = local_media_href(local_path)
+            if href:
+                local_media[media_url] = href
+                if original_url:
+                    local_media.setdefault(original_url, href)
+    return local_media
+
+MEDIA_ATTRIBUTE = re.compile(r'''(\s(?:src|poster)=)(["'])(.*?)\2''', re.IGNORECASE)
+SRCSET_ATTRIBUTE = re.compile(r'''(\ssrcset=)(["'])(.*?)\2''', re.IGNORECASE)
+
+def localize_html(value, local_media):
+    """Point src/poster/srcset URLs in post HTML at downloaded copies"""
+    if not value or not local_media:
+        return value
+
+    def replace_url(match):
+        local = local_media.get(html.unescape(match.group(3)))
+        return f'{match.group(1)}{match.group(2)}{local}{match.group(2)}' if local else match.group(0)
+
+    def replace_srcset(match):
+        # Keep only the candidates that are stored locally, if there are any.
+        candidates = []
+        for candidate in match.group(3).split(','):
+            url, _, descriptor = candidate.strip().partition(' ')
+            local = local_media.get(html.unescape(url))
+            if local:
+                candidates.append(f'{local} {descriptor}'.strip())
+        if not candidates:
+            return match.group(0)
+        return f'{match.group(1)}{match.group(2)}{", ".join(candidates)}{match.group(2)}'
+
+    return SRCSET_ATTRIBUTE.sub(replace_srcset, MEDIA_ATTRIBUTE.sub(replace_url, value))
+
+def localize_content(content, local_media, thumbnails=None):
+    """Rewrite a format_post_content() result to use downloaded media and thumbnails"""
+    content['photos'] = [
+        dict(photo, url=local_media.get(photo['url'], photo['url']),
+             thumbnails=(thumbnails or {}).get(photo['url']))
+        for photo in content['photos']
+    ]
+    if not local_media:
+        return content
+    for field in ('video_url', 'audio_url'):
+        content[field] = local_media.get(content[field], content[field])
+    for field in ('body', 'description', 'source', 'quote'):
+        content[field] = localize_html(content[field], local_media)
+    return content
 
-    elif post_type == 'video':
-        content['video_url'] = raw_data.get('video_url', '')
-        content['body'] = raw_data.get('caption', '')
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last as a prefix"""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
 
-    elif post_type == 'audio':
-        content['audio_url'] = raw_data.get('audio_url', '')
-        content['body'] = raw_data.get('caption', '')
+def highlight(snippet):
+    text = str(escape(snippet or ''))
+    return Markup(text.replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>'))
 
+def format_post_content(post):
+    """Format post content based on type"""
+    if 'raw_data' in post.keys():
+        content = extract_render_fields(decode_raw_data(post['raw_data']))
+    else:
+        content = {column: post[column] or '' for column in RENDER_COLUMNS}
+        content['chat'] = json.loads(content['chat'] or '[]')
+        content['photos'] = json.loads(content['photos'] or '[]')
+    content['summary'] = post['summary'] or ''
     return content
 
 @app.route('/')
+@cached_response
 def index():
     page = request.args.get('page', 1, type=int)
     per_page = 20
@@ -78,12 +400,17 @@ def index():
     blog = request.args.get('blog', 'febuiles')
 
     conn = get_db_connection()
+    if not has_render_fields(conn):
+        return "Posts need upgrading; run 'python tumblr_backup.py rebuild-render-fields' first.", 503
     where_conditions = []
     params = []
 
-    if search:
-        where_conditions.append("(posts.summary LIKE ? OR posts.raw_data LIKE ?)")
-        params.extend([f'%{search}%', f'%{search}%'])
+    match = fts_query(search) if search else None
+    use_index = bool(match) and has_search_index(conn)
+
+    if search and not use_index:
+        where_conditions.append("posts.summary LIKE ?")
+        params.append(f'%{search}%')
 
     if post_type:
         where_conditions.append("posts.type = ?")
@@ -93,21 +420,75 @@ def index():
         where_conditions.append("posts.blog_name = ?")
         params.append(blog)
 
-    where_clause = ' AND '.join(where_conditions) if where_conditions else '1=1'
-    count_query = f"SELECT COUNT(*) FROM posts WHERE {where_clause}"
-    total_posts = conn.execute(count_query, params).fetchone()[0]
     offset = (page - 1) * per_page
-    query = f"""
-        SELECT * FROM posts
-        WHERE {where_clause}
-        ORDER BY timestamp DESC
-        LIMIT ? OFFSET ?
-    """
-    posts = conn.execute(query, params + [per_page, offset]).fetchall()
-    blogs = conn.execute("SELECT DISTINCT blog_name FROM posts ORDER BY blog_name").fetchall()
-    types = conn.execute("SELECT DISTINCT type FROM posts ORDER BY type").fetchall()
+    newer_cursor = older_cursor = None
+    if use_index:
+        where_conditions.insert(0, "posts_fts MATCH ?")
+        params.insert(0, match)
+        where_clause = ' AND '.join(where_conditions)
+        total_posts = conn.execute(f"""
+            SELECT COUNT(*) FROM posts_fts
+            JOIN posts ON posts.id = posts_fts.rowid
+            WHERE {where_clause}
+        """, params).fetchone()[0]
+        posts = conn.execute(f"""
+            SELECT {LISTING_COLUMNS}, snippet(posts_fts, -1, ?, ?, '…', 24) AS snippet
+            FROM posts_fts
+            JOIN posts ON posts.id = posts_fts.rowid
+            {LISTING_JOIN}
+            WHERE {where_clause}
+            ORDER BY bm25(posts_fts, 10.0, 1.0, 5.0, 2.0)
+            LIMIT ? OFFSET ?
+        """, [MATCH_START, MATCH_END] + params + [per_page, offset]).fetchall()
+    else:
+        # Keyset pagination: pages are addressed by the (timestamp, id) of
+        # the post they continue from, so any page costs an index seek.
+        before = parse_cursor(request.args.get('before'))
+        after = parse_cursor(request.args.get('after'))
+        where_clause = ' AND '.join(where_conditions) if where_conditions else '1=1'
+        count_query = f"SELECT COUNT(*) FROM posts WHERE {where_clause}"
+        total_posts = cached_query(('count', where_clause, tuple(params)),
+                                   lambda: conn.execute(count_query, params).fetchone()[0])
+
+        if after:
+            cursor_clause, order, cursor_params = "(posts.timestamp, posts.id) > (?, ?)", "ASC", list(after)
+        elif before:
+            cursor_clause, order, cursor_params = "(posts.timestamp, posts.id) < (?, ?)", "DESC", list(before)
+        else:
+            cursor_clause, order, cursor_params = "1=1", "DESC", []
+
+        query = f"""
+            SELECT {LISTING_COLUMNS} FROM posts
+            {LISTING_JOIN}
+            WHERE {where_clause} AND {cursor_clause}
+            ORDER BY posts.timestamp {order}, posts.id {order}
+            LIMIT ?
+        """
+        # Old ?page=N links without a cursor still work, by offset.
+        query_params = params + cursor_params + [per_page + 1]
+        if page > 1 and not (before or after):
+            query += " OFFSET ?"
+            query_params.append(offset)
+        posts = conn.execute(query, query_params).fetchall()
+
+        has_more = len(posts) > per_page
+        posts = posts[:per_page]
+        if after:
+            posts.reverse()
+            newer_cursor = make_cursor(posts[0]) if has_more else None
+            older_cursor = make_cursor(posts[-1]) if posts else None
+        else:
+            newer_cursor = make_cursor(posts[0]) if posts and (before or page > 1) else None
+            older_cursor = make_cursor(posts[-1]) if has_more else None
+
+    blogs = cached_query('blogs', lambda: conn.execute(
+        "SELECT DISTINCT blog_name FROM posts ORDER BY blog_name").fetchall())
+    types = cached_query('types', lambda: conn.execute(
+        "SELECT DISTINCT type FROM posts ORDER BY type").fetchall())
+
+    thumbnails = lookup_thumbnails(conn, [post['id'] for post in posts if post['type'] == 'photo'])
+    local_media = lookup_local_media(conn, [post['id'] for post in posts])
 
-    conn.close()
     total_pages = (total_posts + per_page - 1) // per_page
 
     return render_template('index.html',
@@ -115,14 +496,19 @@ def index():
                          page=page,
                          total_pages=total_pages,
                          total_posts=total_posts,
+                         newer_cursor=newer_cursor,
+                         older_cursor=older_cursor,
                          search=search,
                          post_type=post_type,
                          blog=blog,
                          blogs=blogs,
                          types=types,
-                         format_post_content=format_post_content)
+                         format_post_content=lambda post: localize_content(
+                             format_post_content(post), local_media, thumbnails),
+                         highlight=highlight)
 
 @app.route('/post/<int:post_id>')
+@cached_response
 def post_detail(post_id):
     conn = get_db_connection()
 
@@ -142,75 +528,107 @@ def post_detail(post_id):
         ORDER BY tags.tag_name
     """, (post_id,)).fetchall()
 
-    conn.close()
+    local_media = {}
+    for media_file in media:
+        href = local_media_href(media_file['local_path'])
+        if href:
+            local_media[media_file['media_url']] = href
+            if media_file['original_url']:
+                local_media.setdefault(media_file['original_url'], href)
 
     return render_template('post_detail.html',
                          post=post,
+                         content=localize_content(format_post_content(post), local_media),
                          media=media,
-                         tags=tags,
-                         format_post_content=format_post_content)
+                         tags=tags)
 
 @app.route('/media/<path:filename>')
 def serve_media(filename):
-    return send_from_directory(app.config['MEDIA_FOLDER'], filename)
+    # Relative to the working directory, like the paths the backup stores;
+    # Flask would otherwise resolve it against the app's package folder.
+    return send_from_directory(os.path.abspath(app.config['MEDIA_FOLDER']), filename)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/stats')
+@cached_response
 def stats():
     conn = get_db_connection()
 
-    stats_data = {}
-    type_counts = conn.execute("""
-        SELECT type, COUNT(*) as count
-        FROM posts
-        GROUP BY type
-        ORDER BY count DESC
-    """).fetchall()
+    # Everything here comes from the rollup tables the backup maintains, so
+    # the page never scans posts or media.
+    try:
+        type_counts = conn.execute("""
+            SELECT type, SUM(post_count) as count
+            FROM post_stats
+            GROUP BY type
+            HAVING count > 0
+            ORDER BY count DESC
+        """).fetchall()
+    except sqlite3.OperationalError:
+        return "Statistics are not available yet; run 'python tumblr_backup.py rebuild-stats' first.", 503
     blog_counts = conn.execute("""
-        SELECT blog_name, COUNT(*) as count
-        FROM posts
+        SELECT blog_name, SUM(post_count) as count
+        FROM post_stats
         GROUP BY blog_name
+        HAVING count > 0
         ORDER BY count DESC
     """).fetchall()
     media_stats = conn.execute("""
         SELECT
-            COUNT(*) as total_media,
-            SUM(CASE WHEN downloaded = 1 THEN 1 ELSE 0 END) as downloaded_media,
-            COUNT(DISTINCT media_type) as media_types
-        FROM media
+            TOTAL(item_count) as total_media,
+            TOTAL(CASE WHEN status = 'done' THEN item_count ELSE 0 END) as downloaded_media,
+            TOTAL(CASE WHEN status = 'done' THEN total_bytes ELSE 0 END) as downloaded_bytes,
+            TOTAL(CASE WHEN status = 'failed' THEN item_count ELSE 0 END) as failed_media,
+            COUNT(DISTINCT CASE WHEN item_count > 0 THEN media_type END) as media_types
+        FROM media_stats
     """).fetchone()
-    total_posts = conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
-    date_range = conn.execute("""
-        SELECT MIN(date) as earliest, MAX(date) as latest
-        FROM posts
+    totals = conn.execute("""
+        SELECT TOTAL(post_count) as total_posts, MIN(earliest_date) as earliest, MAX(latest_date) as latest
+        FROM post_stats
+        WHERE post_count > 0
     """).fetchone()
 
-    conn.close()
-
     stats_data = {
-        'total_posts': total_posts,
+        'total_posts': int(totals['total_posts']),
         'type_counts': type_counts,
         'blog_counts': blog_counts,
-        'media_stats': media_stats,
-        'date_range': date_range
+        'media_stats': {key: int(media_stats[key]) for key in media_stats.keys()},
+        'date_range': totals
     }
 
     return render_template('stats.html', stats=stats_data)
 
 @app.route('/api/search')
+@cached_response
 def api_search():
     query = request.args.get('q', '')
     if not query:
         return jsonify([])
 
     conn = get_db_connection()
-    results = conn.execute("""
-        SELECT id, blog_name, type, summary, date
-        FROM posts
-        WHERE summary LIKE ? OR raw_data LIKE ?
-        ORDER BY timestamp DESC
-        LIMIT 10
-    """, (f'%{query}%', f'%{query}%')).fetchall()
-    conn.close()
+    match = fts_query(query)
+    if match and has_search_index(conn):
+        results = conn.execute("""
+            SELECT posts.id, posts.blog_name, posts.type, posts.summary, posts.date,
+                   snippet(posts_fts, -1, ?, ?, '…', 16) AS snippet
+            FROM posts_fts
+            JOIN posts ON posts.id = posts_fts.rowid
+            WHERE posts_fts MATCH ?
+            ORDER BY bm25(posts_fts, 10.0, 1.0, 5.0, 2.0)
+            LIMIT 10
+        """, (MATCH_START, MATCH_END, match)).fetchall()
+        results = [dict(row, snippet=str(highlight(row['snippet']))) for row in results]
+    else:
+        results = conn.execute("""
+            SELECT id, blog_name, type, summary, date
+            FROM posts
+            WHERE summary LIKE ?
+            ORDER BY timestamp DESC
+            LIMIT 10
+        """, (f'%{query}%',)).fetchall()
 
     return jsonify([dict(row) for row in results])
 